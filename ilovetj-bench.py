@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2020 Tejun Heo <tj@kernel.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import argparse
+import os
+import sys
+import json
+import random
+import shutil
+import statistics
+import subprocess
+import threading
+import time
+import hashlib
+import platform
+import zlib
+
+desc = '''
+Benchmark ilovetj.py over a synthetic pdf corpus.
+
+The corpus is generated from a fixed seed so that it's identical between
+runs. It contains vector text pages, photo-heavy pages and pages of mixed
+sizes, and the filenames exercise the sorting and --label-sep handling.
+
+ilovetj.py is run over the grid of --dpi, --concurrency and --decor values
+--repeat times each. For each configuration, the median wall time,
+pages/sec, peak RSS of ilovetj.py and of the commands it ran, peak
+temporary directory usage and the output size are reported as JSON.
+
+Decor:
+
+  plain     no header, footer, label or page number
+  frame     header and footer
+  annotate  label and page number
+  all       header, footer, label and page number
+
+If --baseline is specified, the results are compared against a previous
+result file. Configurations whose pages/sec dropped by more than
+--threshold percents are reported and the exit status is 1.
+
+EXAMPLE:
+
+  $ ilovetj-bench.py -o before.json
+  ... apply changes ...
+  $ ilovetj-bench.py -o after.json --baseline before.json
+'''
+
+DECOR_CHOICES = [ 'plain', 'frame', 'annotate', 'all' ]
+
+parser = argparse.ArgumentParser(description=desc,
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('--output', '-o', metavar='JSON',
+                    help='write the results into JSON in addition to stdout')
+parser.add_argument('--workdir', metavar='DIR', default='ilovetj-bench',
+                    help='directory for the corpus and runs (default: %(default)s)')
+parser.add_argument('--ilovetj', metavar='PATH',
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         'ilovetj.py'),
+                    help='ilovetj.py to benchmark (default: %(default)s)')
+parser.add_argument('--dpi', metavar='DPI[,DPI...]', default='100,200',
+                    help='dpi values to run (default: %(default)s)')
+parser.add_argument('--concurrency', metavar='N[,N...]',
+                    default=f'1,{os.cpu_count()}',
+                    help='concurrency values to run (default: %(default)s)')
+parser.add_argument('--decor', metavar='DECOR[,DECOR...]', default=','.join(DECOR_CHOICES),
+                    help='decorations to run, see above (default: %(default)s)')
+parser.add_argument('--extra-args', metavar='ARGS', default='',
+                    help='extra arguments to pass to ilovetj.py, e.g. "--fused"')
+parser.add_argument('--scale', type=int, default=1,
+                    help='multiply the number of pages in the corpus (default: %(default)s)')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='number of runs for each configuration (default: %(default)s)')
+parser.add_argument('--seed', type=int, default=20200429,
+                    help='seed for the corpus generation (default: %(default)s)')
+parser.add_argument('--baseline', metavar='JSON',
+                    help='compare against the results in JSON')
+parser.add_argument('--threshold', metavar='PCT', type=float, default=10,
+                    help='pages/sec drop to report as regression (default: %(default)s)')
+parser.add_argument('--verbose', '-v', action='count', default = 0)
+
+def err(msg):
+    print(msg, file=sys.stderr)
+    sys.stderr.flush()
+    sys.exit(1)
+
+def info(msg):
+    print(msg, file=sys.stderr)
+    sys.stderr.flush()
+
+def dbg(msg):
+    if prog_args.verbose > 0:
+        print(msg, file=sys.stderr)
+        sys.stderr.flush()
+
+# page sizes in points
+LETTER = (612, 792)
+LETTER_LANDSCAPE = (792, 612)
+LEGAL = (612, 1008)
+A4 = (595, 842)
+A5 = (420, 595)
+
+WORDS = ('fixture vendor spec load rating voltage lumen housing finish mount '
+         'driver lens optic beam angle dimming control emergency battery '
+         'sensor wattage efficacy color temperature index').split()
+
+def text_content(rng, page_size):
+    # lines of text in a few sizes with some vector rules and boxes
+    (w, h) = page_size
+    out = [ f'0.2 0.2 0.2 RG 1 w 36 {h - 60} m {w - 36} {h - 60} l S\n' ]
+    y = h - 90
+    while y > 60:
+        pointsize = rng.choice([ 8, 9, 10, 12, 14 ])
+        words = ' '.join(rng.choice(WORDS) for i in range(rng.randint(4, 14)))
+        out.append(f'BT /F1 {pointsize} Tf 48 {y} Td ({words}) Tj ET\n')
+        if rng.random() < 0.1:
+            out.append(f'0.8 0.9 1 rg 48 {y - 40} {w - 96} 30 re f\n')
+            y -= 40
+        y -= pointsize * 1.6
+    return ''.join(out).encode('latin-1')
+
+def photo_image(rng, width, height):
+    # smooth gradients with noise on top, which compresses like a photo
+    noise = rng.getrandbits(width * height * 8).to_bytes(width * height, 'little')
+    data = bytearray(width * height * 3)
+    i = 0
+    for y in range(height):
+        for x in range(width):
+            n = noise[y * width + x] >> 3
+            data[i] = (x * 255 // width + n) & 0xff
+            data[i + 1] = (y * 255 // height + n) & 0xff
+            data[i + 2] = ((x + y) * 127 // (width + height) + n) & 0xff
+            i += 3
+    return bytes(data)
+
+def write_pdf(path, pages):
+    '''
+    Write a pdf with Helvetica as /F1. pages is a list of (size, content,
+    images) where images maps names used in content to (width, height, rgb).
+    '''
+    objs = [ b'<< /Type /Catalog /Pages 2 0 R >>', None,
+             b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>' ]
+    kids = []
+    for (page_size, content, images) in pages:
+        xobjects = ''
+        for (name, (width, height, rgb)) in images.items():
+            data = zlib.compress(rgb)
+            objs.append(f'<< /Type /XObject /Subtype /Image /Width {width} '
+                        f'/Height {height} /ColorSpace /DeviceRGB '
+                        f'/BitsPerComponent 8 /Filter /FlateDecode '
+                        f'/Length {len(data)} >>\nstream\n'.encode() +
+                        data + b'\nendstream')
+            xobjects += f'/{name} {len(objs)} 0 R '
+        data = zlib.compress(content)
+        objs.append(f'<< /Filter /FlateDecode /Length {len(data)} >>\nstream\n'.encode() +
+                    data + b'\nendstream')
+        content_nr = len(objs)
+        objs.append(f'<< /Type /Page /Parent 2 0 R '
+                    f'/MediaBox [0 0 {page_size[0]} {page_size[1]}] '
+                    f'/Resources << /Font << /F1 3 0 R >> /XObject << {xobjects}>> >> '
+                    f'/Contents {content_nr} 0 R >>'.encode())
+        kids.append(f'{len(objs)} 0 R')
+    objs[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'.encode()
+
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for (i, obj) in enumerate(objs):
+            offsets.append(f.tell())
+            f.write(f'{i + 1} 0 obj\n'.encode() + obj + b'\nendobj\n')
+        xref_offset = f.tell()
+        f.write(f'xref\n0 {len(objs) + 1}\n0000000000 65535 f \n'.encode())
+        for offset in offsets:
+            f.write(f'{offset:010d} 00000 n \n'.encode())
+        f.write(f'trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\n'
+                f'startxref\n{xref_offset}\n%%EOF\n'.encode())
+
+def text_page(rng, page_size):
+    return (page_size, text_content(rng, page_size), {})
+
+def photo_page(rng, page_size):
+    (w, h) = page_size
+    content = (f'q {w - 72} 0 0 {(h - 144) * 0.6:.0f} 36 {h * 0.35:.0f} cm /Im0 Do Q\n'
+               f'q {(w - 90) / 2:.0f} 0 0 {h * 0.25:.0f} 36 48 cm /Im1 Do Q\n'
+               f'q {(w - 90) / 2:.0f} 0 0 {h * 0.25:.0f} {w / 2 + 9:.0f} 48 cm /Im1 Do Q\n')
+    images = { 'Im0': (320, 240, photo_image(rng, 320, 240)),
+               'Im1': (160, 120, photo_image(rng, 160, 120)) }
+    return (page_size, content.encode(), images)
+
+def mixed_page(rng, page_size):
+    (size, content, images) = photo_page(rng, page_size)
+    return (size, text_content(rng, page_size) + content, images)
+
+# (filename, [ (page generator, page size) ]) before --scale is applied.
+# The names mix separators, numbers which sort differently as strings and
+# a whitespace.
+CORPUS = [
+    ('L1-VENDOR1-FIXTURE1.pdf', [ (text_page, LETTER) ] * 6),
+    ('L2-VENDOR2-FIXTURE2.pdf', [ (photo_page, LETTER) ] * 4),
+    ('L10-VENDOR1-FIXTURE3.pdf', [ (text_page, A4), (mixed_page, LETTER_LANDSCAPE),
+                                   (text_page, LEGAL), (photo_page, A5) ]),
+    ('D1_VENDOR3 FIXTURE1.pdf', [ (mixed_page, LETTER) ] * 3),
+    ('D1-VENDOR3-FIXTURE2.pdf', [ (text_page, A4) ] * 2),
+    ('D1-VENDOR3-FIXTURE10.pdf', [ (photo_page, A4) ] * 2),
+    ('S2-SPEC-LONG.pdf', [ (text_page, LETTER), (text_page, LETTER),
+                           (mixed_page, LETTER), (text_page, A4) ] * 6),
+]
+
+def generate_corpus(corpus_dir):
+    # regenerated only if the seed or scale changed
+    stamp = f'{prog_args.seed} {prog_args.scale}'
+    stamp_path = os.path.join(corpus_dir, '.stamp')
+    try:
+        with open(stamp_path) as f:
+            if f.read() == stamp:
+                return
+    except OSError:
+        pass
+
+    info(f'Generating corpus in "{corpus_dir}"...')
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    os.makedirs(corpus_dir)
+    rng = random.Random(prog_args.seed)
+    for (name, specs) in CORPUS:
+        pages = [ gen(rng, page_size) for (gen, page_size) in specs * prog_args.scale ]
+        write_pdf(os.path.join(corpus_dir, name), pages)
+    with open(stamp_path, 'w') as f:
+        f.write(stamp)
+
+def corpus_info(corpus_dir):
+    h = hashlib.sha256()
+    files = sorted(name for name in os.listdir(corpus_dir) if name.endswith('.pdf'))
+    for name in files:
+        with open(os.path.join(corpus_dir, name), 'rb') as f:
+            h.update(name.encode() + b'\0' + f.read())
+    nr_pages = sum(len(specs) for (name, specs) in CORPUS) * prog_args.scale
+    return { 'files': files, 'pages': nr_pages, 'sha256': h.hexdigest() }
+
+def write_png(path, width, height, rgb):
+    def chunk(ctype, data):
+        return (len(data).to_bytes(4, 'big') + ctype + data +
+                zlib.crc32(ctype + data).to_bytes(4, 'big'))
+    raw = b''.join(b'\0' + rgb[y * width * 3:(y + 1) * width * 3]
+                   for y in range(height))
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' +
+                chunk(b'IHDR', width.to_bytes(4, 'big') + height.to_bytes(4, 'big') +
+                      bytes([ 8, 2, 0, 0, 0 ])) +
+                chunk(b'IDAT', zlib.compress(raw)) +
+                chunk(b'IEND', b''))
+
+def generate_decor(decor_dir):
+    os.makedirs(decor_dir, exist_ok=True)
+    rng = random.Random(prog_args.seed)
+    for (name, width, height) in [ ('header.png', 1200, 120), ('footer.png', 1200, 240) ]:
+        path = os.path.join(decor_dir, name)
+        if not os.path.exists(path):
+            write_png(path, width, height, photo_image(rng, width, height))
+
+def decor_args(decor, decor_dir):
+    args = []
+    if decor in ('frame', 'all'):
+        args += [ '--header', os.path.join(decor_dir, 'header.png'),
+                  '--footer', os.path.join(decor_dir, 'footer.png') ]
+    if decor in ('annotate', 'all'):
+        args += [ '--label-sep', '-', '--number-start', '1' ]
+    return args
+
+def dir_size(path):
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def trace_max_rss(trace_path):
+    try:
+        with open(trace_path) as f:
+            events = json.load(f)['traceEvents']
+    except (OSError, ValueError, KeyError):
+        return None
+    return max([ ev['args'].get('child_max_rss', 0) for ev in events ] + [ 0 ])
+
+def run_one(corpus_dir, run_dir, args):
+    # The temporary and scratch directories are put under run_dir so that
+    # their usage can be sampled and doesn't depend on /dev/shm.
+    shutil.rmtree(run_dir, ignore_errors=True)
+    tmp_dir = os.path.join(run_dir, 'tmp')
+    os.makedirs(tmp_dir)
+    output = os.path.join(run_dir, 'output.pdf')
+    trace = os.path.join(run_dir, 'trace.json')
+    cmd = [ sys.executable, prog_args.ilovetj,
+            '--scratch-dir', os.path.join(tmp_dir, 'scratch'),
+            '--trace', trace, '-o', output ] + args + [ corpus_dir ]
+    env = dict(os.environ, TMPDIR=tmp_dir, TEMP=tmp_dir, TMP=tmp_dir)
+    dbg(f'Running {cmd}')
+
+    peak_tmp = 0
+    done = threading.Event()
+    def sample_fn():
+        nonlocal peak_tmp
+        while not done.wait(0.05):
+            peak_tmp = max(peak_tmp, dir_size(tmp_dir))
+    sampler = threading.Thread(target=sample_fn)
+
+    start = time.monotonic()
+    p = subprocess.Popen(cmd, env=env, stderr=None if prog_args.verbose > 1 else
+                         subprocess.DEVNULL)
+    sampler.start()
+    (pid, status, rusage) = os.wait4(p.pid, 0)
+    wall = time.monotonic() - start
+    done.set()
+    sampler.join()
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if p.returncode != 0:
+        raise Exception(f'{cmd} failed with exit status {p.returncode}')
+
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    return { 'wall': wall,
+             'max_rss': rusage.ru_maxrss * rss_unit,
+             'child_max_rss': trace_max_rss(trace),
+             'peak_tmp_bytes': peak_tmp,
+             'output_bytes': os.path.getsize(output) }
+
+def config_key(cfg):
+    return (cfg['dpi'], cfg['concurrency'], cfg['decor'], cfg['extra_args'])
+
+def compare(results, baseline):
+    base = { config_key(r['config']): r for r in baseline['results'] }
+    if baseline.get('corpus', {}).get('sha256') != corpus['sha256']:
+        info('Warning: the baseline was measured on a different corpus')
+    nr_regressions = 0
+    info(f'{"dpi":>5} {"conc":>5} {"decor":<9} {"base p/s":>9} {"p/s":>9} {"change":>8}')
+    for r in results:
+        b = base.get(config_key(r['config']))
+        if b is None:
+            continue
+        old = b['median']['pages_per_sec']
+        new = r['median']['pages_per_sec']
+        change = (new - old) / old * 100
+        mark = ''
+        if change < -prog_args.threshold:
+            mark = ' REGRESSION'
+            nr_regressions += 1
+        cfg = r['config']
+        info(f'{cfg["dpi"]:>5} {cfg["concurrency"]:>5} {cfg["decor"]:<9} '
+             f'{old:>9.2f} {new:>9.2f} {change:>+7.1f}%{mark}')
+    return nr_regressions
+
+def tool_version(cmd):
+    try:
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode(
+            'utf-8', 'replace').splitlines()[0].strip()
+    except Exception:
+        return None
+
+def git_rev():
+    try:
+        return subprocess.check_output(
+            [ 'git', 'rev-parse', 'HEAD' ], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(prog_args.ilovetj))).decode().strip()
+    except Exception:
+        return None
+
+# main starts here
+prog_args = parser.parse_args()
+
+if not hasattr(os, 'wait4'):
+    err('os.wait4() is required to measure the resource usage')
+
+try:
+    dpis = [ int(v) for v in prog_args.dpi.split(',') ]
+    concurrencies = [ int(v) for v in prog_args.concurrency.split(',') ]
+except ValueError as e:
+    err(f'--dpi and --concurrency must be comma separated integers ({e})')
+decors = prog_args.decor.split(',')
+for decor in decors:
+    if decor not in DECOR_CHOICES:
+        err(f'Unknown decor "{decor}", must be one of {", ".join(DECOR_CHOICES)}')
+extra_args = prog_args.extra_args.split()
+
+corpus_dir = os.path.join(prog_args.workdir, 'corpus')
+decor_dir = os.path.join(prog_args.workdir, 'decor')
+generate_corpus(corpus_dir)
+generate_decor(decor_dir)
+corpus = corpus_info(corpus_dir)
+
+results = []
+for dpi in dpis:
+    for concurrency in concurrencies:
+        for decor in decors:
+            cfg = { 'dpi': dpi, 'concurrency': concurrency, 'decor': decor,
+                    'extra_args': prog_args.extra_args }
+            args = ([ '--dpi', f'{dpi}', '--concurrency', f'{concurrency}' ] +
+                    decor_args(decor, decor_dir) + extra_args)
+            runs = []
+            for i in range(prog_args.repeat):
+                info(f'Running dpi={dpi} concurrency={concurrency} decor={decor} '
+                     f'({i + 1}/{prog_args.repeat})...')
+                try:
+                    runs.append(run_one(corpus_dir,
+                                        os.path.join(prog_args.workdir, 'run'), args))
+                except Exception as e:
+                    err(e)
+            wall = statistics.median(r['wall'] for r in runs)
+            median = { 'wall': wall,
+                       'pages_per_sec': corpus['pages'] / wall,
+                       'max_rss': statistics.median(r['max_rss'] for r in runs),
+                       'child_max_rss': statistics.median(r['child_max_rss'] or 0
+                                                          for r in runs),
+                       'peak_tmp_bytes': statistics.median(r['peak_tmp_bytes']
+                                                           for r in runs),
+                       'output_bytes': runs[-1]['output_bytes'] }
+            info(f'  {median["pages_per_sec"]:.2f} pages/sec, {wall:.2f}s')
+            results.append({ 'config': cfg, 'median': median, 'runs': runs })
+
+report = {
+    'env': { 'ilovetj_rev': git_rev(),
+             'python': platform.python_version(),
+             'platform': platform.platform(),
+             'cpus': os.cpu_count(),
+             'gs': tool_version([ 'gs', '--version' ]),
+             'convert': tool_version([ 'convert', '-version' ]) },
+    'corpus': corpus,
+    'seed': prog_args.seed,
+    'scale': prog_args.scale,
+    'repeat': prog_args.repeat,
+    'results': results }
+
+json.dump(report, sys.stdout, indent=2)
+print()
+if prog_args.output is not None:
+    with open(prog_args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+if prog_args.baseline is not None:
+    try:
+        with open(prog_args.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError) as e:
+        err(f'Failed to read baseline "{prog_args.baseline}" ({e})')
+    nr_regressions = compare(results, baseline)
+    if nr_regressions > 0:
+        err(f'{nr_regressions} configurations regressed by more than '
+            f'{prog_args.threshold}%')
@@ -25,7 +25,18 @@ import glob
 import re
 import tempfile
 import threading
+import heapq
 import time
+import hashlib
+import zlib
+import json
+import contextlib
+import collections
+import socket
+import socketserver
+import http.server
+import http.client
+import stat
 
 desc = '''
 Annotate pages from source pdfs and collect them into a single pdf.
@@ -35,6 +46,12 @@ Annotate pages from source pdfs and collect them into a single pdf.
   names on whitespaces, '-', and '-'. Sorting can be disabled with
   --keep-order.
 
+* Only some pages of a source pdf can be used by appending the page ranges
+  to its name, e.g. "cutsheet.pdf[1-3,7,10-]", or by listing them in a
+  sidecar file with the same name and .pages extension, e.g.
+  "cutsheet.pages". Pages which aren't selected are never rendered.
+  Labels and page numbers follow the selected pages.
+
 * If specified, header and footer images are attached to each page. The
   source page is shrunk to fit. The heights of the header and footer are
   specified in percents of the total page height.
@@ -59,6 +76,80 @@ ImageMagick. All pages in the output pdf are bitmaps. The resolution can be
 changed with --dpi. To install ghostscript and ImageMagick, visit
 https://www.ghostscript.com and https://imagemagick.org.
 
+By default, each processing stage (resize, header/footer merge, label and
+page number) runs as a separate ImageMagick command. --fused processes each
+page with a single command, which avoids most of the process and png
+encoding overhead on large documents.
+With --batch, each command processes a batch of
+pages, which avoids most of the remaining process startup overhead.
+
+With --split-pages, --split-size or --split-labels, the output is split into
+parts named OUTPUT-part001.pdf, OUTPUT-part002.pdf and so on. A new part is
+started once a limit would be exceeded or at each new label. The parts are
+written in parallel and --split-index lists the pages, labels and page
+numbers of each part in OUTPUT.index.json or OUTPUT.index.pdf. With
+--linearize, the output or each part is linearized with qpdf
+(https://qpdf.sourceforge.io) so that viewers can show the first page while
+the rest is still loading. --numbered-output numbers split outputs as a
+whole, e.g. OUTPUT.1-part001.pdf.
+
+With --vector, source pages aren't rasterized. They're scaled into the body
+area as vector graphics and labels and page numbers are drawn as text, so
+the output stays searchable and small. This requires pypdf
+(https://pypi.org/project/pypdf).
+
+With --manifest FILE, multiple outputs are built in one run. FILE is JSON,
+or YAML if it ends with .yaml or .yml (requires PyYAML). Each entry of
+"outputs" maps long option names to values and "sources" to the source
+list. "defaults" is applied to every output. Paths are relative to FILE.
+Source pages shared between outputs are rendered once per geometry and
+headers, footers and labels are built once.
+
+    {
+      "defaults": { "label-sep": "-", "header": "header.png" },
+      "outputs": [
+        { "output": "floor1.pdf", "sources": [ "SPECS/L1-A.pdf", "SPECS/L2-B.pdf" ] },
+        { "output": "all.pdf", "sources": [ "SPECS" ], "number-start": 1 }
+      ]
+    }
+
+With --serve ADDR, ilovetj keeps running and processes jobs submitted over
+http on localhost or a unix socket. Discovered binaries, the worker pool,
+resized header and footer images, rendered glyphs and the page cache are
+kept across jobs. Jobs are processed one at a time in submission order and
+use all workers. The following requests are supported.
+
+  POST /jobs     {"args": [ARG...], "wait": false}
+                 Queue a job. ARGs are the command line arguments except
+                 for the server options --concurrency, --max-memory,
+                 --max-scratch, --cache-dir, --cache-size, --tempdir,
+                 --scratch-dir, --trace and --verbose which are taken from
+                 the server. Relative paths are relative to the server's
+                 working directory. If "wait" is true, the response is sent
+                 when the job finishes.
+  GET /jobs/NR   The state, output path, error and latency of a job.
+  GET /status    The queue depth and job latency statistics.
+
+    $ ilovetj.py --serve unix:/tmp/ilovetj.sock
+    $ curl --unix-socket /tmp/ilovetj.sock -d '{"args": ["-o", "/tmp/out.pdf",
+      "--label-sep", "-", "/srv/SPECS"], "wait": true}' http://localhost/jobs
+
+With --workers, rendering and processing are distributed over other hosts
+running ilovetj with --worker. The coordinator splits the pages into tasks
+of up to 16 pages, uploads the source pdfs, headers, footers and fonts to
+the workers which don't have them yet and writes the returned pages into
+the output in order. Each worker runs one task at a time using all of its
+--concurrency and --concurrency of the coordinator limits the tasks in
+flight over all workers. If a worker can't be reached, its tasks are
+reassigned to the others, and if no worker is left, the pages are processed
+locally. Workers execute whatever coordinators send them and should only
+listen on trusted networks.
+
+    worker1$ ilovetj.py --worker 0.0.0.0:8700
+    worker2$ ilovetj.py --worker 0.0.0.0:8700
+    $ ilovetj.py --workers worker1:8700,worker2:8700 --concurrency 8 \\
+      --label-sep - -o output.pdf SPECS
+
 EXAMPLE:
 
   Let's say the SPECS directory contains the following files.
@@ -85,15 +176,24 @@ GRAVITY_CHOICES=['northwest', 'north', 'northeast',
 
 parser = argparse.ArgumentParser(description=desc,
                                  formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument('src', metavar='PDF_OR_DIR', nargs='+',
-                    help='Source PDF files or directories')
-parser.add_argument('--output', '-o', required=True,
+parser.add_argument('src', metavar='PDF_OR_DIR', nargs='*',
+                    help='Source PDF files or directories, a file may be followed by\n'
+                         'the pages to use, e.g. "cutsheet.pdf[1-3,7,10-]"')
+parser.add_argument('--output', '-o',
                     help='Output pdf file')
 parser.add_argument('--numbered-output', metavar='true|false', type=bool,
                     default=platform.system() == 'Windows',
                     help='Append number to output filename to avoid overwriting (default: %(default)s)')
 parser.add_argument('--dpi', '-d', metavar='DPI', type=int, default=300,
                     help='Processing DPI (default: %(default)s)')
+parser.add_argument('--proof', action='store_true',
+                    help='build a quick proof at --proof-dpi with the same layout and\n'
+                         'write OUTPUT.job for building it at --dpi with --promote')
+parser.add_argument('--proof-dpi', metavar='DPI', type=int, default=50,
+                    help='resolution of --proof (default: %(default)s)')
+parser.add_argument('--promote', metavar='JOB',
+                    help='build the output of a --proof run at full resolution from the\n'
+                         'sources, order and page selection recorded in JOB')
 parser.add_argument('--keep-order', action='store_true',
                     help='Keep source PDF order instead of sorting them alphabetically')
 parser.add_argument('--size', metavar='WIDTHxHEIGHT', default='215.9x279.4',
@@ -136,20 +236,130 @@ parser.add_argument('--number-color', metavar='COLOR', default='black',
 parser.add_argument('--number-font', metavar='FONT',
                     help='page number font, "convert -list font" to see the font list')
 
+parser.add_argument('--fused', action='store_true',
+                    help='process each page with a single ImageMagick command instead of one per stage')
+parser.add_argument('--backend', metavar='BACKEND', choices=['magick', 'pillow'],
+                    default='magick',
+                    help='how to process rendered pages (default: %(default)s)\n'
+                         'magick: run ImageMagick commands\n'
+                         'pillow: process in memory with numpy and Pillow\n'
+                         '        (requires numpy and Pillow)')
+parser.add_argument('--batch', action='store_true',
+                    help='process pages in batches with one ImageMagick command per stage\n'
+                         'and batch, which saves the command startup for most pages')
+parser.add_argument('--batch-size', metavar='PAGES', type=int, default=0,
+                    help='pages per batch for --batch, 0 picks by the number of pages\n'
+                         'and --concurrency (default: %(default)s)')
+parser.add_argument('--vector', action='store_true',
+                    help='place source pages into the output without rasterizing them,\n'
+                         'labels and page numbers are drawn as Helvetica-Bold text\n'
+                         '(requires pypdf)')
+parser.add_argument('--assemble', metavar='METHOD', choices=['stream', 'convert'],
+                    default='stream',
+                    help='how to collect pages into the output pdf (default: %(default)s)\n'
+                         'stream: write each page as soon as it\'s processed, memory usage\n'
+                         '        doesn\'t grow with the number of pages\n'
+                         'convert: collect all pages with a single ImageMagick command')
+parser.add_argument('--split-pages', metavar='PAGES', type=int,
+                    help='split the output into parts of at most PAGES pages named\n'
+                         'OUTPUT-part001.pdf, OUTPUT-part002.pdf and so on')
+parser.add_argument('--split-size', metavar='SIZE',
+                    help='split the output into parts of at most SIZE bytes, e.g. 200M,\n'
+                         'requires --assemble stream')
+parser.add_argument('--split-labels', action='store_true',
+                    help='split the output into a part for each label, requires --label-sep')
+parser.add_argument('--split-index', metavar='FORMAT', choices=['json', 'pdf'],
+                    help='also write OUTPUT.index.json or OUTPUT.index.pdf listing the\n'
+                         'pages, labels and page numbers of each part')
+parser.add_argument('--linearize', action='store_true',
+                    help='linearize the output or each part so that viewers can show the\n'
+                         'first page before the whole file is loaded (requires qpdf)')
+parser.add_argument('--intermediate', metavar='FORMAT', choices=['png', 'ppm'],
+                    default='png',
+                    help='format of the intermediate page files (default: %(default)s)\n'
+                         'png: compressed, small but costs cpu time at every stage\n'
+                         'ppm: uncompressed, fast but each page takes width x height x 3 bytes')
+parser.add_argument('--scratch-dir', metavar='DIR',
+                    help='directory for the intermediate page files (default: /dev/shm if\n'
+                         'it has enough free space, the temporary directory otherwise)')
+parser.add_argument('--dedupe', action='store_true',
+                    help='embed identical pages once in the output pdf, labels and page\n'
+                         'numbers are drawn as separate overlay images')
+parser.add_argument('--encoding', metavar='METHOD',
+                    choices=['rgb', 'auto', 'gray', 'bilevel', 'jpeg'], default='rgb',
+                    help='how to encode the pages in the output pdf (default: %(default)s)\n'
+                         'rgb: lossless 24bit color\n'
+                         'auto: classify each page and pick one of the following, the\n'
+                         '      header, footer, labels and page numbers are drawn as\n'
+                         '      separate images shared by all pages\n'
+                         'gray: lossless 8bit gray\n'
+                         'bilevel: black and white in CCITT group 4\n'
+                         'jpeg: lossy, for photos and scans')
+parser.add_argument('--jpeg-quality', metavar='QUALITY', type=int, default=85,
+                    help='jpeg quality for --encoding (default: %(default)s)')
 parser.add_argument('--concurrency', type=int, default=os.cpu_count(),
                     help='maximum concurrency (default: %(default)s)')
+parser.add_argument('--max-memory', metavar='SIZE',
+                    help='memory budget for concurrent jobs, new jobs wait while the\n'
+                         'estimated usage would exceed it, 0 for no limit\n'
+                         '(default: 80%% of the available memory)')
+parser.add_argument('--max-scratch', metavar='SIZE',
+                    help='limit on the intermediate files, rendering waits while it\n'
+                         'would be exceeded (default: 90%% of the free space)')
+parser.add_argument('--watch', action='store_true',
+                    help='keep running and rebuild the output when source pdfs change')
+parser.add_argument('--watch-interval', metavar='SECS', type=float, default=2,
+                    help='interval to check the sources for --watch (default: %(default)s)')
+parser.add_argument('--manifest', metavar='FILE',
+                    help='build all outputs described in JSON or YAML FILE sharing the\n'
+                         'work between them, see below')
+parser.add_argument('--serve', metavar='ADDR',
+                    help='keep running and process jobs submitted over http on ADDR,\n'
+                         '[HOST:]PORT or unix:PATH, see below')
+parser.add_argument('--worker', metavar='ADDR',
+                    help='keep running and render and process pages for --workers\n'
+                         'coordinators on ADDR, [HOST:]PORT, see below')
+parser.add_argument('--workers', metavar='ADDR[,ADDR...]',
+                    help='render and process the pages on the --worker processes at\n'
+                         'ADDRs, HOST:PORT, and only write the output locally')
+parser.add_argument('--cache-dir', metavar='DIR',
+                    help='cache rendered and processed pages in DIR and reuse them in later runs')
+parser.add_argument('--cache-size', metavar='SIZE', default='10G',
+                    help='maximum cache size, least recently used pages are evicted, also\n'
+                         'limits the files uploaded to a --worker (default: %(default)s)')
+parser.add_argument('--clear-cache', action='store_true',
+                    help='clear the cache before processing, exit if no source is specified')
+parser.add_argument('--trace', metavar='FILE',
+                    help='record the timing and resource usage of each page and stage\n'
+                         'into FILE in the Chrome trace event format and print a summary,\n'
+                         'later builds of --serve, --watch or --manifest go to FILE.1 and\n'
+                         'so on, e.g. trace.1.json')
 parser.add_argument('--verbose', '-v', action='count', default = 0)
 parser.add_argument('--tempdir', metavar='DIR',
-                    help='specify explicit temporary directory for debugging')
+                    help='specify explicit temporary directory for debugging, completed\n'
+                         'pages are recorded in DIR/journal for --resume')
+parser.add_argument('--resume', action='store_true',
+                    help='continue an interrupted run in --tempdir reusing the pages\n'
+                         'recorded in its journal which are still intact')
+
+class CommandError(Exception):
+    pass
 
 def is_windows():
     return platform.system() == 'Windows'
 
 def err(msg):
+    # remembered to report why a --serve job failed
+    global last_error
+    last_error = f'{msg}'
     print(msg, file=sys.stderr)
     sys.stderr.flush()
     sys.exit(1)
 
+def warn(msg):
+    print(msg, file=sys.stderr)
+    sys.stderr.flush()
+
 def info(msg):
     if prog_args.verbose >= 0:
         print(msg, file=sys.stderr)
@@ -165,6 +375,137 @@ def ddbg(msg):
         print(msg, file=sys.stderr)
         sys.stderr.flush()
 
+class Tracer:
+    '''
+    Records spans of jobs and stages along with the commands run in them
+    for --trace. Spans nest per thread. The resource usage of a command and
+    the size of files written are added to all the spans it's running in.
+    The events are written out in the Chrome trace event format, which can
+    be loaded into chrome://tracing or https://ui.perfetto.dev.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.t0 = time.monotonic()
+        self.events = []
+        self.nr_writes = 0
+        self.tids = {}
+        self.stats = {}
+
+    def now_us(self, t=None):
+        return int(((time.monotonic() if t is None else t) - self.t0) * 1000000)
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, desc, wait=0):
+        span = { 'name': name, 'desc': desc, 'start': time.monotonic(),
+                 'wait': wait, 'cpu': 0, 'rss': 0, 'bytes': 0 }
+        self.stack().append(span)
+        try:
+            yield
+        finally:
+            self.stack().pop()
+            self.add_event(span, time.monotonic())
+
+    def add_event(self, span, end):
+        wall = end - span['start']
+        with self.lock:
+            self.events.append({ 'name': span['name'], 'cat': 'stage', 'ph': 'X',
+                                 'ts': self.now_us(span['start']),
+                                 'dur': self.now_us(end) - self.now_us(span['start']),
+                                 'pid': 0, 'tid': self.tid_locked(),
+                                 'args': { 'desc': span['desc'],
+                                           'wait_ms': int(span['wait'] * 1000),
+                                           'child_cpu_ms': int(span['cpu'] * 1000),
+                                           'child_max_rss': span['rss'],
+                                           'bytes_written': span['bytes'] } })
+            st = self.stats.setdefault(span['name'], [ 0, 0, 0, 0, 0, 0 ])
+            st[0] += 1
+            st[1] += wall
+            st[2] += span['wait']
+            st[3] += span['cpu']
+            st[4] = max(st[4], span['rss'])
+            st[5] += span['bytes']
+
+    def tid_locked(self):
+        # number threads in the order they show up, more readable than idents
+        ident = threading.get_ident()
+        if ident not in self.tids:
+            self.tids[ident] = len(self.tids)
+        return self.tids[ident]
+
+    def add_command(self, name, cmd, start, rusage):
+        cpu = 0
+        rss = 0
+        if rusage is not None:
+            cpu = rusage.ru_utime + rusage.ru_stime
+            # ru_maxrss is in kilobytes except on macos
+            rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        for span in self.stack():
+            span['cpu'] += cpu
+            span['rss'] = max(span['rss'], rss)
+        span = { 'name': name, 'desc': ' '.join(cmd), 'start': start,
+                 'wait': 0, 'cpu': cpu, 'rss': rss, 'bytes': 0 }
+        self.add_event(span, time.monotonic())
+
+    def add_bytes(self, nr_bytes):
+        for span in self.stack():
+            span['bytes'] += nr_bytes
+
+    def write(self, path):
+        # Write out and drop the events recorded since the last write. Each
+        # build of --serve, --watch and --manifest is written into its own
+        # file, path for the first and then path numbered like
+        # --numbered-output.
+        with self.lock:
+            events = self.events
+            self.events = []
+            nr = self.nr_writes
+            self.nr_writes += 1
+        if nr > 0:
+            (base, ext) = os.path.splitext(path)
+            path = f'{base}.{nr}{ext}'
+        with open(path, 'w') as f:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+
+    def print_summary(self):
+        with self.lock:
+            stats = self.stats
+            self.stats = {}
+        info(f'{"stage":<12} {"count":>6} {"wall(s)":>9} {"wait(s)":>9} '
+             f'{"cpu(s)":>9} {"max rss":>9} {"written":>9}')
+        for (name, st) in sorted(stats.items(), key=lambda x: -x[1][1]):
+            info(f'{name:<12} {st[0]:>6} {st[1]:>9.2f} {st[2]:>9.2f} '
+                 f'{st[3]:>9.2f} {format_size(st[4]):>9} {format_size(st[5]):>9}')
+
+def format_size(nr_bytes):
+    for unit in [ '', 'K', 'M', 'G' ]:
+        if nr_bytes < 1024 or unit == 'G':
+            break
+        nr_bytes /= 1024
+    return f'{nr_bytes:.1f}{unit}' if unit else f'{nr_bytes}'
+
+def trace_span(name, desc, wait=0):
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.span(name, desc, wait)
+
+def trace_command(name, cmd, start, rusage):
+    if tracer is not None:
+        tracer.add_command(name, cmd, start, rusage)
+
+def trace_file(path):
+    # account the size of a file written by the current spans
+    if tracer is not None:
+        try:
+            tracer.add_bytes(os.path.getsize(path))
+        except OSError:
+            pass
+
 def sectioned_mixed_key(x):
     sections = re.split('-|_|\W', x)
     keys = []
@@ -186,6 +527,59 @@ def sectioned_mixed_key(x):
 def stem_name(path):
     return os.path.splitext(os.path.basename(path))[0]
 
+def parse_page_selection(spec):
+    '''
+    Parse page selection like "1-3,7,10-" into a list of (first, last)
+    ranges where last is None for the end of the document. Raises an
+    exception if spec is malformed.
+    '''
+    ranges = []
+    for part in re.split(r'[,\s]+', spec.strip()):
+        if part == '':
+            continue
+        m = re.fullmatch(r'(\d+)(?:-(\d*))?', part)
+        if m is None:
+            raise Exception(f'invalid page range "{part}"')
+        first = int(m.group(1))
+        if m.group(2) is None:
+            last = first
+        elif m.group(2) == '':
+            last = None
+        else:
+            last = int(m.group(2))
+        if first < 1 or (last is not None and last < first):
+            raise Exception(f'invalid page range "{part}"')
+        ranges.append((first, last))
+    if len(ranges) == 0:
+        raise Exception('no page selected')
+    return ranges
+
+def selected_pages(ranges, nr_pages):
+    # page numbers selected by ranges of parse_page_selection() in order
+    nrs = set()
+    for (first, last) in ranges:
+        if last is None:
+            last = nr_pages
+        if max(first, last) > nr_pages:
+            raise Exception(f'page {max(first, last)} selected out of {nr_pages}')
+        nrs.update(range(first, last + 1))
+    return sorted(nrs)
+
+def page_list(nrs):
+    # format sorted page numbers as ranges, e.g. [1, 2, 3, 7] -> "1-3,7"
+    parts = []
+    first = nrs[0]
+    for (i, nr) in enumerate(nrs):
+        if i + 1 < len(nrs) and nrs[i + 1] == nr + 1:
+            continue
+        parts.append(f'{first}' if first == nr else f'{first}-{nr}')
+        if i + 1 < len(nrs):
+            first = nrs[i + 1]
+    return ','.join(parts)
+
+def sidecar_path(pdf):
+    return os.path.splitext(pdf)[0] + '.pages'
+
 def sorted_mixed_basename(l):
     return sorted(l, key = lambda key: sectioned_mixed_key(stem_name(key)))
 
@@ -208,114 +602,2834 @@ def find_magick_bin(cmd, win_glob=None):
         return None
     return bin_path
 
-def run_gs(args):
+def run_command(name, cmd, capture=True, line_fn=None):
+    '''
+    Run cmd and return its stdout. If line_fn is specified, it's called with
+    each line of stdout as it's read instead. The resource usage of the
+    child is recorded for --trace. Raises an exception if cmd fails.
+    '''
+    dbg(f'Running {cmd}')
+    start = time.monotonic()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE if capture else None)
+    out = []
+    rusage = None
+    try:
+        if capture:
+            for line in p.stdout:
+                if line_fn is None:
+                    out.append(line)
+                else:
+                    line_fn(line)
+            p.stdout.close()
+    except BaseException:
+        p.kill()
+        raise
+    finally:
+        if hasattr(os, 'wait4'):
+            (pid, status, rusage) = os.wait4(p.pid, 0)
+            if os.WIFEXITED(status):
+                p.returncode = os.WEXITSTATUS(status)
+            else:
+                p.returncode = -os.WTERMSIG(status)
+        else:
+            p.wait()
+        trace_command(name, cmd, start, rusage)
+    if p.returncode != 0:
+        raise Exception(f'exit status {p.returncode}')
+    return b''.join(out).decode('utf-8', 'replace')
+
+def gs_output(args):
     cmd = [GS_BIN]
     cmd += args
-    dbg(f'Running {cmd}')
     try:
-        subprocess.check_call(cmd)
+        return run_command('gs', cmd)
     except Exception as e:
-        err(f'ghostscript command ({cmd}) failed ({e})')
+        raise CommandError(f'ghostscript command ({cmd}) failed ({e})')
 
-def run_convert(args):
+# on_page_start(nr) is called when ghostscript starts on the nr'th output page
+def run_gs_pages(args, on_page_start):
+    cmd = [GS_BIN]
+    cmd += args
+    nr = 0
+    def line_fn(line):
+        nonlocal nr
+        if re.match(rb'^Page [0-9]+', line):
+            nr += 1
+            on_page_start(nr)
+        else:
+            ddbg(f'gs: {line.decode("utf-8", "replace").rstrip()}')
+    try:
+        run_command('gs', cmd, line_fn=line_fn)
+    except Exception as e:
+        raise CommandError(f'ghostscript command ({cmd}) failed ({e})')
+
+def convert_output(args):
     if MAGICK_BIN is None:
         cmd = [CONVERT_BIN]
     else:
         cmd = [MAGICK_BIN, 'convert']
-    cmd += args
-    dbg(f'Running {cmd}')
+    cmd += magick_limit_args + args
     try:
-        subprocess.check_call(cmd)
+        return run_command('convert', cmd)
     except Exception as e:
-        err(f'convert command ({cmd}) failed ({e})')
+        raise CommandError(f'convert command ({cmd}) failed ({e})')
 
-def run_composite(args):
+def run_convert(args):
     if MAGICK_BIN is None:
-        cmd = [COMPOSITE_BIN]
+        cmd = [CONVERT_BIN]
     else:
-        cmd = [MAGICK_BIN, 'composite']
-    cmd += args
-    dbg(f'Running {cmd}')
+        cmd = [MAGICK_BIN, 'convert']
+    cmd += magick_limit_args + args
     try:
-        subprocess.check_call(cmd)
+        run_command('convert', cmd, capture=False)
     except Exception as e:
-        err(f'composite command ({cmd}) failed ({e})')
+        raise CommandError(f'convert command ({cmd}) failed ({e})')
+    # the last argument is the output file, optionally with a format prefix
+    trace_file(re.sub(r'^[A-Za-z0-9]{2,}:', '', args[-1]))
 
 def resize_header(src, dst, size):
     info(f'Resizing {src} to {size[0]}x{size[1]}')
-    run_convert([src,
-                 '(', '-resize', f'{size[0]}x{size[1]}', ')',
-                 '(', '-gravity', 'West', '-extent', f'{size[0]}x{size[1]}', ')',
-                 dst])
+    args = [src,
+            '(', '-resize', f'{size[0]}x{size[1]}', ')',
+            '(', '-gravity', 'West', '-extent', f'{size[0]}x{size[1]}', ')']
+    if prog_args.intermediate != 'png':
+        # the pages can't carry alpha, flatten the header like the writer would
+        args += [ '-background', 'white', '-alpha', 'remove', '-alpha', 'off' ]
+    run_convert(args + [ dst ])
 
-def run_parallel(args_set, runfn, max_active):
-    dbg(f'run_parallel: args_set={args_set}')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
-    nr_active = 0
-    threads = []
-    for arg in args_set:
-        nr_active += 1
+def png_info(path):
+    '''
+    Scan the chunks of a png file without decoding the image. Returns a
+    dict describing the image and the locations of its IDAT chunks, or None
+    if the image can't be embedded into a pdf as-is (alpha or interlace).
+    '''
+    png = { 'idats': [] }
+    with open(path, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        while True:
+            hdr = f.read(8)
+            if len(hdr) < 8:
+                return None
+            length = int.from_bytes(hdr[:4], 'big')
+            ctype = hdr[4:]
+            if ctype == b'IHDR':
+                data = f.read(length)
+                png['width'] = int.from_bytes(data[0:4], 'big')
+                png['height'] = int.from_bytes(data[4:8], 'big')
+                png['depth'] = data[8]
+                png['color_type'] = data[9]
+                if data[9] not in (0, 2, 3) or data[12] != 0:
+                    return None
+            elif ctype == b'PLTE':
+                png['palette'] = f.read(length)
+            elif ctype == b'IDAT':
+                png['idats'].append((f.tell(), length))
+                f.seek(length, os.SEEK_CUR)
+            elif ctype == b'IEND':
+                break
+            else:
+                f.seek(length, os.SEEK_CUR)
+            f.seek(4, os.SEEK_CUR)      # crc
+    if 'width' not in png or len(png['idats']) == 0:
+        return None
+    return png
 
-        def run_and_dec(arg):
-            nonlocal nr_active
-            runfn(arg)
-            nr_active -= 1
+# magic, width, height and maxval separated by whitespaces and comments
+PNM_HEADER_RE = re.compile(rb'(P[56])(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)'
+                           rb'(?:\s|#[^\n]*\n)+(\d+)\s')
 
-        t = threading.Thread(target=lambda: run_and_dec(arg))
-        t.start()
+def pnm_info(path):
+    '''
+    Parse the header of a binary ppm or pgm file. Returns a dict describing
+    the image and the offset of its pixel data, or None if it isn't one.
+    '''
+    with open(path, 'rb') as f:
+        m = PNM_HEADER_RE.match(f.read(1024))
+    if m is None or int(m.group(4)) not in (255, 65535):
+        return None
+    return { 'width': int(m.group(2)),
+             'height': int(m.group(3)),
+             'depth': 8 if int(m.group(4)) == 255 else 16,
+             'colors': 3 if m.group(1) == b'P6' else 1,
+             'offset': m.end() }
 
-        threads.append(t)
-        while nr_active >= max_active:
-            time.sleep(0.1)
+def jpeg_info(path):
+    '''
+    Scan the markers of a jpeg file up to its frame header. Returns a dict
+    with the size and number of components, or None if it isn't a baseline
+    or progressive jpeg in gray or rgb.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            hdr = f.read(4)
+            if len(hdr) < 4 or hdr[0] != 0xff:
+                return None
+            length = int.from_bytes(hdr[2:], 'big')
+            if hdr[1] in (0xc0, 0xc1, 0xc2):
+                data = f.read(6)
+                if len(data) < 6 or data[5] not in (1, 3):
+                    return None
+                return { 'width': int.from_bytes(data[3:5], 'big'),
+                         'height': int.from_bytes(data[1:3], 'big'),
+                         'colors': data[5] }
+            f.seek(length - 2, os.SEEK_CUR)
 
-    for t in threads:
-        t.join()
+def tiff_g4_info(path):
+    '''
+    Parse the first directory of a tiff file. Returns a dict with the size,
+    polarity and the location of the single strip of CCITT group 4 data, or
+    None if the image isn't in that form. Strips are encoded independently
+    and can't be concatenated, so the file must be written with one strip.
+    libtiff writes the directory after the strip, so it's read from its
+    offset rather than from the head of the file.
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(8)
+        if len(head) != 8:
+            return None
+        if head[:4] == b'II*\x00':
+            order = 'little'
+        elif head[:4] == b'MM\x00*':
+            order = 'big'
+        else:
+            return None
+        f.seek(int.from_bytes(head[4:8], order))
+        data = f.read(2)
+        if len(data) != 2:
+            return None
+        nr_entries = int.from_bytes(data, order)
+        data = f.read(nr_entries * 12)
+        if len(data) != nr_entries * 12:
+            return None
+        file_size = os.fstat(f.fileno()).st_size
 
-def generate_label_args(label, font, height, color, gravity, filename):
-    args = []
+    u16 = lambda off: int.from_bytes(data[off:off + 2], order)
+    u32 = lambda off: int.from_bytes(data[off:off + 4], order)
+    # The values used here are single SHORTs or LONGs which are stored in
+    # the entries. Anything else, e.g. multiple strips, isn't supported.
+    tags = {}
+    for i in range(nr_entries):
+        ent = i * 12
+        (tag, typ, count) = (u16(ent), u16(ent + 2), u32(ent + 4))
+        if count != 1:
+            tags[tag] = None
+        elif typ == 3:
+            tags[tag] = u16(ent + 8)
+        elif typ == 4:
+            tags[tag] = u32(ent + 8)
+    if (tags.get(259) != 4 or tags.get(258, 1) != 1 or tags.get(266, 1) != 1 or
+        tags.get(273) is None or tags.get(279) is None or 256 not in tags or
+        257 not in tags or tags[273] + tags[279] > file_size):
+        return None
+    return { 'width': tags[256],
+             'height': tags[257],
+             'black_is_1': tags.get(262, 0) == 1,
+             'offset': tags[273],
+             'length': tags[279] }
+
+def embeddable(path):
+    # whether PdfWriter can take the image at path without conversion
+    return png_info(path) is not None or pnm_info(path) is not None
+
+def smask_ref(smask):
+    return f'/SMask {smask} 0 R ' if smask is not None else ''
+
+class PdfWriter:
+    '''
+    Minimal pdf writer which writes bitmap pages one by one. png, jpeg and
+    group 4 tiff pages are embedded by copying their compressed data, so
+    memory usage doesn't depend on the page size or count. ppm and pgm
+    pages are compressed before being written out. Pages can be added from
+    multiple threads in any order. The pages are ordered by their index at
+    close().
+    After close(), subsets of the pages can be copied into pdfs of their
+    own with write_part().
+    '''
+    # bytes of a part besides its objects, i.e. the header, catalog, page
+    # tree and trailer, of each object's cross-reference entry and of each
+    # page's entry in the page tree
+    PART_OVERHEAD = 512
+    XREF_ENTRY = 20
+    PAGE_ENTRY = 16
+
+    def __init__(self, path, dpi):
+        # write into a temporary file so that path is replaced atomically
+        self.path = path
+        self.tmp_path = f'{path}.tmp'
+        self.dpi = dpi
+        self.lock = threading.Lock()
+        self.f = open(self.tmp_path, 'wb')
+        self.offsets = {}
+        self.lengths = {}
+        self.refs = {}              # object numbers referenced by each object
+        self.nr_objs = 2            # 1: catalog, 2: page tree
+        self.page_objs = {}
+        self.images = {}            # shared images, see add_layered_page()
+        self.nr_shared = 0
+        self.f.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+
+    def alloc_obj(self):
+        self.nr_objs += 1
+        return self.nr_objs
+
+    def write_obj(self, nr, body, stream=None, stream_len=0):
+        self.offsets[nr] = self.f.tell()
+        self.f.write(f'{nr} 0 obj\n'.encode())
+        if stream is None:
+            self.f.write(body.encode())
+        else:
+            self.f.write(f'{body[:-2]}/Length {stream_len} >>\nstream\n'.encode())
+            for data in stream:
+                self.f.write(data)
+            self.f.write(b'\nendstream')
+        self.f.write(b'\nendobj\n')
+        self.lengths[nr] = self.f.tell() - self.offsets[nr]
+        self.refs[nr] = [ int(ref) for ref in re.findall(r'([0-9]+) 0 R', body)
+                          if int(ref) > 2 ]
+
+    def png_stream(self, path, png):
+        with open(path, 'rb') as f:
+            for (offset, length) in png['idats']:
+                f.seek(offset)
+                while length > 0:
+                    data = f.read(min(length, 1 << 20))
+                    length -= len(data)
+                    yield data
+
+    def add_png_image(self, path, png, smask=None):
+        depth = png['depth']
+        if png['color_type'] == 3:
+            palette = png['palette']
+            colorspace = (f'[/Indexed /DeviceRGB {len(palette) // 3 - 1} '
+                          f'<{palette.hex()}>]')
+            colors = 1
+        elif png['color_type'] == 0:
+            colorspace = '/DeviceGray'
+            colors = 1
+        else:
+            colorspace = '/DeviceRGB'
+            colors = 3
+
+        nr = self.alloc_obj()
+        body = (f'<< /Type /XObject /Subtype /Image '
+                f'/Width {png["width"]} /Height {png["height"]} '
+                f'/ColorSpace {colorspace} /BitsPerComponent {depth} '
+                f'/Filter /FlateDecode /DecodeParms << /Predictor 15 '
+                f'/Colors {colors} /BitsPerComponent {depth} '
+                f'/Columns {png["width"]} >> {smask_ref(smask)}>>')
+        stream_len = sum(length for (offset, length) in png['idats'])
+        self.write_obj(nr, body, self.png_stream(path, png), stream_len)
+        return nr
+
+    def add_pnm_image(self, path, pnm, smask=None):
+        # compress outside the lock so that pages are compressed in parallel
+        deflate = zlib.compressobj()
+        data = []
+        with open(path, 'rb') as f:
+            f.seek(pnm['offset'])
+            while True:
+                buf = f.read(1 << 20)
+                if len(buf) == 0:
+                    break
+                data.append(deflate.compress(buf))
+        data.append(deflate.flush())
+
+        colorspace = '/DeviceRGB' if pnm['colors'] == 3 else '/DeviceGray'
+        body = (f'<< /Type /XObject /Subtype /Image '
+                f'/Width {pnm["width"]} /Height {pnm["height"]} '
+                f'/ColorSpace {colorspace} /BitsPerComponent {pnm["depth"]} '
+                f'/Filter /FlateDecode {smask_ref(smask)}>>')
+        with self.lock:
+            nr = self.alloc_obj()
+            self.write_obj(nr, body, data, sum(len(d) for d in data))
+        return nr
+
+    def add_file_image(self, path, offset, length, body):
+        # embed length bytes at offset of path as an image stream as-is
+        def stream():
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                left = length
+                while left > 0:
+                    data = f.read(min(left, 1 << 20))
+                    if len(data) == 0:
+                        raise Exception(f'"{path}" is truncated')
+                    left -= len(data)
+                    yield data
+        with self.lock:
+            nr = self.alloc_obj()
+            self.write_obj(nr, body, stream(), length)
+        return nr
+
+    def add_image(self, path, smask=None):
+        '''
+        Add png, ppm, pgm, jpeg or group 4 tiff image at path and return
+        (object number, width, height). smask is the object number of the
+        image's soft mask.
+        '''
+        png = png_info(path)
+        if png is not None:
+            with self.lock:
+                return (self.add_png_image(path, png, smask), png['width'], png['height'])
+        pnm = pnm_info(path)
+        if pnm is not None:
+            return (self.add_pnm_image(path, pnm, smask), pnm['width'], pnm['height'])
+        jpeg = jpeg_info(path)
+        if jpeg is not None:
+            colorspace = '/DeviceRGB' if jpeg['colors'] == 3 else '/DeviceGray'
+            body = (f'<< /Type /XObject /Subtype /Image '
+                    f'/Width {jpeg["width"]} /Height {jpeg["height"]} '
+                    f'/ColorSpace {colorspace} /BitsPerComponent 8 '
+                    f'/Filter /DCTDecode {smask_ref(smask)}>>')
+            nr = self.add_file_image(path, 0, os.path.getsize(path), body)
+            return (nr, jpeg['width'], jpeg['height'])
+        g4 = tiff_g4_info(path)
+        if g4 is not None:
+            black_is_1 = ' /BlackIs1 true' if g4['black_is_1'] else ''
+            body = (f'<< /Type /XObject /Subtype /Image '
+                    f'/Width {g4["width"]} /Height {g4["height"]} '
+                    f'/ColorSpace /DeviceGray /BitsPerComponent 1 '
+                    f'/Filter /CCITTFaxDecode /DecodeParms << /K -1 '
+                    f'/Columns {g4["width"]} /Rows {g4["height"]}{black_is_1} >> '
+                    f'{smask_ref(smask)}>>')
+            nr = self.add_file_image(path, g4['offset'], g4['length'], body)
+            return (nr, g4['width'], g4['height'])
+        raise Exception(f'"{path}" is not an image which can be embedded')
+
+    def add_font(self, name):
+        with self.lock:
+            nr = self.alloc_obj()
+            self.write_obj(nr, f'<< /Type /Font /Subtype /Type1 /BaseFont /{name} '
+                           f'/Encoding /WinAnsiEncoding >>')
+            return nr
+
+    def add_page_content(self, idx, w, h, content, xobjects={}, fonts={}):
+        '''
+        Add the idx'th page of w x h points drawn by content. xobjects and
+        fonts map the resource names used in content to object numbers.
+        '''
+        res = ''
+        if len(xobjects) > 0:
+            res += ('/XObject << ' +
+                    ' '.join(f'/{k} {v} 0 R' for (k, v) in xobjects.items()) +
+                    ' >> ')
+        if len(fonts) > 0:
+            res += ('/Font << ' +
+                    ' '.join(f'/{k} {v} 0 R' for (k, v) in fonts.items()) +
+                    ' >> ')
+        content = content.encode('latin-1')
+        with self.lock:
+            content_nr = self.alloc_obj()
+            self.write_obj(content_nr, '<< >>', [content], len(content))
+            page_nr = self.alloc_obj()
+            self.write_obj(page_nr,
+                           f'<< /Type /Page /Parent 2 0 R '
+                           f'/MediaBox [0 0 {w:.4f} {h:.4f}] '
+                           f'/Resources << {res}>> '
+                           f'/Contents {content_nr} 0 R >>')
+            self.page_objs[idx] = page_nr
+
+    def add_page(self, idx, path, max_size):
+        '''
+        Add png image at path as the idx'th page. The image is scaled down
+        to fit max_size in pixels like "convert -resize" would.
+        '''
+        (img_nr, img_w, img_h) = self.add_image(path)
+        scale = min(max_size[0] / img_w, max_size[1] / img_h, 1)
+        w = img_w * scale * 72 / self.dpi
+        h = img_h * scale * 72 / self.dpi
+        self.add_page_content(idx, w, h, f'q {w:.4f} 0 0 {h:.4f} 0 0 cm /Im0 Do Q',
+                              xobjects={ 'Im0': img_nr })
+
+    def shared_image(self, key, path, mask=None):
+        # Images are looked up by key, so a racing add of the same key may
+        # embed it twice, which is harmless. None key isn't shared.
+        with self.lock:
+            if key in self.images:
+                self.nr_shared += 1
+                return self.images[key]
+        smask = None
+        if mask is not None:
+            (smask, mask_w, mask_h) = self.add_image(mask)
+        img = self.add_image(path, smask)
+        if key is None:
+            return img
+        with self.lock:
+            return self.images.setdefault(key, img)
+
+    def add_layered_page(self, idx, page_size, layers):
+        '''
+        Add the idx'th page of page_size pixels composed of layers drawn in
+        order. layers is a list of (path, mask_path, key, x, y) where (x, y)
+        is the top-left position in pixels. Images are embedded once per key
+        and shared by all pages using the key. path may be None if the key
+        has already been added.
+        '''
+        px_to_pt = 72 / self.dpi
+        w = page_size[0] * px_to_pt
+        h = page_size[1] * px_to_pt
+        content = ''
+        xobjects = {}
+        for (i, (path, mask, key, x, y)) in enumerate(layers):
+            (img_nr, img_w, img_h) = self.shared_image(key, path, mask)
+            content += (f'q {img_w * px_to_pt:.4f} 0 0 {img_h * px_to_pt:.4f} '
+                        f'{x * px_to_pt:.4f} {h - (y + img_h) * px_to_pt:.4f} cm '
+                        f'/Im{i} Do Q\n')
+            xobjects[f'Im{i}'] = img_nr
+        self.add_page_content(idx, w, h, content, xobjects=xobjects)
+
+    def write_tail(self, page_nrs):
+        # Write the catalog, the page tree of page_nrs and the
+        # cross-reference table of the objects in self.offsets, which
+        # consists of a subsection for each run of consecutive objects.
+        kids = ' '.join(f'{nr} 0 R' for nr in page_nrs)
+        self.write_obj(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        self.write_obj(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(page_nrs)} >>')
+
+        nrs = sorted(self.offsets)
+        runs = []
+        for nr in [ 0 ] + nrs:
+            if len(runs) > 0 and runs[-1][-1] == nr - 1:
+                runs[-1].append(nr)
+            else:
+                runs.append([ nr ])
+        xref_offset = self.f.tell()
+        self.f.write(b'xref\n')
+        for run in runs:
+            self.f.write(f'{run[0]} {len(run)}\n'.encode())
+            for nr in run:
+                if nr == 0:
+                    self.f.write(b'0000000000 65535 f \n')
+                else:
+                    self.f.write(f'{self.offsets[nr]:010d} 00000 n \n'.encode())
+        self.f.write(f'trailer\n<< /Size {nrs[-1] + 1} /Root 1 0 R >>\n'
+                     f'startxref\n{xref_offset}\n%%EOF\n'.encode())
+
+    def close(self):
+        self.write_tail([ self.page_objs[idx] for idx in sorted(self.page_objs) ])
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def page_objects(self, idx):
+        # numbers of the objects which make up the idx'th page
+        objs = set()
+        todo = [ self.page_objs[idx] ]
+        while len(todo) > 0:
+            nr = todo.pop()
+            if nr not in objs:
+                objs.add(nr)
+                todo += self.refs[nr]
+        return objs
+
+    def objects_size(self, objs):
+        return sum(self.lengths[nr] + self.XREF_ENTRY for nr in objs)
+
+    def write_part(self, idxs, path):
+        '''
+        Write the pages idxs of the closed pdf into path as a pdf of their
+        own. The objects are copied as-is keeping their numbers, so the
+        cross-reference table skips the ones which aren't used.
+        '''
+        objs = set()
+        for idx in idxs:
+            objs |= self.page_objects(idx)
+        part = PdfWriter(path, self.dpi)
+        with open(self.path, 'rb') as f:
+            for nr in sorted(objs):
+                part.offsets[nr] = part.f.tell()
+                f.seek(self.offsets[nr])
+                left = self.lengths[nr]
+                while left > 0:
+                    data = f.read(min(left, 1 << 20))
+                    if len(data) == 0:
+                        raise Exception(f'"{self.path}" is truncated')
+                    part.f.write(data)
+                    left -= len(data)
+        part.write_tail([ self.page_objs[idx] for idx in sorted(idxs) ])
+        part.f.close()
+        os.replace(part.tmp_path, part.path)
+
+    def abort(self):
+        self.f.close()
+        os.unlink(self.tmp_path)
+
+class WorkerPool:
+    '''
+    Fixed number of workers executing submitted jobs. Queued jobs are
+    executed in the order of ascending prio, descending cost and then
+    submission order. Jobs may submit more jobs. Failures are collected and
+    returned by wait() instead of terminating the program from workers.
+
+    Jobs declare the memory they need and the scratch space they fill. The
+    next job is started only if it fits in max_mem along with the running
+    jobs and, if it fills scratch space, if scratch_fn() plus its scratch
+    stays below max_scratch. A job is always started if nothing is running
+    so that an oversized job can't stall the pool.
+
+    prio_limits caps the running jobs of a prio so that long jobs, e.g.
+    rendering, can't take all the workers and leave none for the jobs which
+    drain their output.
+    '''
+    def __init__(self, nr_workers, max_mem=None):
+        self.cond = threading.Condition()
+        self.queue = []
+        self.seq = 0
+        self.nr_pending = 0
+        self.nr_running = 0
+        self.mem_used = 0
+        self.max_mem = max_mem
+        self.max_scratch = None
+        self.scratch_fn = None
+        self.prio_limits = {}
+        self.nr_running_prio = collections.Counter()
+        self.failures = []
+        for i in range(max(nr_workers, 1)):
+            threading.Thread(target=self.worker_fn, daemon=True).start()
+
+    def submit(self, desc, fn, arg, cost=0, prio=0, mem=0, scratch=0):
+        with self.cond:
+            heapq.heappush(self.queue, (prio, -cost, self.seq, desc, fn, arg,
+                                        time.monotonic(), mem, scratch))
+            self.seq += 1
+            self.nr_pending += 1
+            self.cond.notify_all()
+
+    def admissible(self, prio, mem, scratch):
+        if (prio in self.prio_limits and
+            self.nr_running_prio[prio] >= self.prio_limits[prio]):
+            return False
+        if self.nr_running == 0:
+            return True
+        if self.max_mem is not None and self.mem_used + mem > self.max_mem:
+            return False
+        if (scratch > 0 and self.max_scratch is not None and
+            self.scratch_fn() + scratch > self.max_scratch):
+            return False
+        return True
+
+    def wait(self):
+        with self.cond:
+            while self.nr_pending > 0:
+                self.cond.wait()
+            failures = self.failures
+            self.failures = []
+        return failures
+
+    def worker_fn(self):
+        while True:
+            with self.cond:
+                # the head job waits for running jobs to finish if it
+                # doesn't fit, which keeps the priority order
+                while (len(self.queue) == 0 or
+                       not self.admissible(self.queue[0][0], self.queue[0][7],
+                                           self.queue[0][8])):
+                    self.cond.wait()
+                (prio, cost, seq, desc, fn, arg, queued_at, mem, scratch) = \
+                    heapq.heappop(self.queue)
+                self.nr_running += 1
+                self.nr_running_prio[prio] += 1
+                self.mem_used += mem
+            ddbg(f'WorkerPool: {desc} prio={prio} cost={-cost} mem={mem} '
+                 f'scratch={scratch}')
+            try:
+                # jobs are traced by the first word of desc, e.g. "rendering"
+                with trace_span(desc.split(' ', 1)[0], desc,
+                                wait=time.monotonic() - queued_at):
+                    fn(arg)
+            except Exception as e:
+                with self.cond:
+                    self.failures.append((desc, e))
+            with self.cond:
+                self.nr_running -= 1
+                self.nr_running_prio[prio] -= 1
+                self.mem_used -= mem
+                self.nr_pending -= 1
+                self.cond.notify_all()
+
+def check_failures(failures):
+    if len(failures) == 0:
+        return
+    for (desc, e) in failures[:10]:
+        warn(f'Failed {desc} ({e})')
+    if len(failures) > 10:
+        warn(f'... and {len(failures) - 10} more failures')
+    err(f'{len(failures)} jobs failed')
+
+def font_args(font):
     if font is not None:
-        args += [ '-font', font ]
+        return [ '-font', font ]
     elif platform.system() == 'Linux':
-        args += [ '-font', 'Bitstream-Vera-Sans-Bold' ]
-
-    args += [ '-background', 'none',
-              '-fill', color,
-              '-size', f'{size[0]}x{height}',
-              '-gravity', GRAVITY_X[gravity],
-              f'label:{label}',
-              filename ]
-    return args
-
-def apply_labels(srcs, label_files, prefix, report_prefix,
-                 height, gravity, margin):
-    labeled = []
-    args_set = []
-    for src in srcs:
-        stem = os.path.splitext(src.split('_', 1)[1])[0]
-        dst = f'{prefix}_{stem}.png'
-
-        src_file = f'{tempdir}/{src}'
-        dst_file = f'{tempdir}/{dst}'
-
-        args = [f'{report_prefix} "{stem}"']
-        args += [ '-gravity', GRAVITY_Y[gravity],
-                  '-geometry', f'-{margin[0]}+{margin[1]}',
-                  label_files[src],
-                  f'{tempdir}/{src}',
-                  f'{tempdir}/{dst}' ]
-
-        args_set.append(args)
-        labeled.append(dst)
-
-    def apply_label_fn(args):
-        info(f'{args[0]}...')
-        run_composite(args[1:])
-
-    run_parallel(args_set, apply_label_fn, prog_args.concurrency)
-    return labeled
+        return [ '-font', 'Bitstream-Vera-Sans-Bold' ]
+    return []
+
+class GlyphAtlas:
+    '''
+    Glyph images of a font, height and color. Text overlays are composed
+    from the glyphs instead of running "convert label:" for each text. All
+    missing glyphs are rendered with a single convert command.
+    '''
+    nr_atlases = 0
+
+    def __init__(self, name, font, height, color):
+        self.name = name
+        self.font = font
+        self.height = height
+        self.color = color
+        self.glyphs = {}
+        self.widths = {}
+        self.nr_batches = 0
+        # distinguishes the glyph files of atlases with the same name
+        self.nr = GlyphAtlas.nr_atlases
+        GlyphAtlas.nr_atlases += 1
+
+    def render(self, chars):
+        chars = sorted(set(chars) - set(self.glyphs))
+        if len(chars) == 0:
+            return
+
+        pattern = f'{tempdir}/GLYPH_{self.name}{self.nr}_{self.nr_batches}_%d.png'
+        self.nr_batches += 1
+
+        args = font_args(self.font)
+        args += [ '-background', 'none', '-fill', self.color,
+                  '-size', f'x{self.height}' ]
+        for c in chars:
+            c = c.replace('\\', '\\\\').replace('%', '%%')
+            if c == '@':
+                c = '\\@'
+            args.append(f'label:{c}')
+        args += [ '+adjoin', pattern ]
+
+        info(f'Rendering {len(chars)} {self.name} glyphs...')
+        run_convert(args)
+        for (i, c) in enumerate(chars):
+            path = pattern.replace('%d', f'{i}')
+            self.glyphs[c] = path
+            # the IHDR chunk comes first in a png
+            with open(path, 'rb') as f:
+                self.widths[c] = int.from_bytes(f.read(24)[16:20], 'big')
+
+    def files(self, text):
+        return [ self.glyphs[c] for c in text ]
+
+    def width(self, text):
+        return sum(self.widths[c] for c in text)
+
+def text_image_args(atlas, text, height, gravity):
+    # size[0] x height image with text aligned to GRAVITY_X[gravity] like
+    # "convert -size {size[0]}x{height} -gravity ... label:TEXT" would,
+    # text wider than the page is shrunk to fit
+    if len(text) == 0:
+        return [ '(', '-size', f'{size[0]}x{height}', 'xc:none', ')' ]
+    args = [ '(', '-background', 'none' ] + atlas.files(text) + [ '+append' ]
+    if atlas.width(text) > size[0]:
+        args += [ '-resize', f'{size[0]}x' ]
+    return args + [ '-gravity', GRAVITY_X[gravity], '-extent', f'{size[0]}x{height}', ')' ]
+
+def text_overlay_args(atlas, text, height, gravity, margin):
+    return (text_image_args(atlas, text, height, gravity) +
+            [ '-gravity', GRAVITY_Y[gravity],
+              '-geometry', f'-{margin[0]}+{margin[1]}',
+              '-composite' ])
+
+# overlay images of layered pages indexed by (atlas, text, gravity, margin),
+# each entry is [lock, nr, result] so that every overlay is made only once
+text_overlays = {}
+text_overlays_lock = threading.Lock()
+
+def text_overlay(atlas, text, height, gravity, margin):
+    '''
+    Return (rgb_path, mask_path, key, x, y) of the text overlay which
+    text_overlay_args() would composite, for PdfWriter.add_layered_page().
+    The overlay is split into color and alpha images so that it can be
+    embedded with a soft mask.
+    '''
+    key = (atlas.nr, text, gravity, margin)
+    with text_overlays_lock:
+        entry = text_overlays.get(key)
+        if entry is None:
+            entry = text_overlays[key] = [threading.Lock(), len(text_overlays), None]
+    (lock, nr, _) = entry
+    with lock:
+        if entry[2] is not None:
+            return entry[2]
+        rgb = f'{tempdir}/OVERLAY_{atlas.name}{atlas.nr}_{nr}.png'
+        mask = f'{tempdir}/OVERLAY_{atlas.name}{atlas.nr}_{nr}_MASK.png'
+        run_convert([ '-respect-parentheses' ] +
+                    text_image_args(atlas, text, height, gravity) +
+                    [ '(', '+clone', '-alpha', 'extract', '-depth', '8',
+                      '-define', 'png:color-type=0', '-write', f'PNG:{mask}', '+delete', ')',
+                      '-alpha', 'off', '-depth', '8', f'PNG24:{rgb}' ])
+        (x, y) = overlay_box((size[0], height), gravity, margin)
+        entry[2] = (rgb, mask, rgb, x, y)
+        return entry[2]
+
+def page_overlays(page):
+    ovs = []
+    if page.label is not None:
+        ovs.append(text_overlay(label_atlas, page.label, label_height,
+                                prog_args.label_gravity, label_margin))
+    if page.number is not None:
+        ovs.append(text_overlay(number_atlas, f'{page.number}', number_height,
+                                prog_args.number_gravity, number_margin))
+    return ovs
+
+class Page:
+    def __init__(self, idx, pdf, pdf_stem, nr):
+        self.idx = idx
+        self.pdf = pdf
+        self.stem = f'{pdf_stem}-{nr}'
+        self.nr = nr
+        self.file = scratch_file('SRC', self.stem)
+        self.label = None
+        self.number = None
+        # pixel size ghostscript renders the page at, None for the full page
+        self.fit = None
+        self.src_key = None
+        self.body_key = None
+        self.key = None
+        # identifies the page's bitmap for --dedupe
+        self.image_key = None
+
+def ps_string(s):
+    return s.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+@contextlib.contextmanager
+def gs_readable(pdf):
+    # --permit-file-read takes a list of paths separated by os.pathsep, so a
+    # pdf with one in its path is read through a link or copy in tempdir
+    if os.pathsep not in pdf:
+        yield pdf
+        return
+    path = f'{tempdir}/QUERY_{threading.get_ident()}.pdf'
+    try:
+        os.link(pdf, path)
+    except OSError:
+        shutil.copyfile(pdf, path)
+    try:
+        yield path
+    finally:
+        os.unlink(path)
+
+def pdf_page_count(pdf):
+    with gs_readable(pdf) as path:
+        out = gs_output([ '-q', '-dNODISPLAY', '-dSAFER', f'--permit-file-read={path}',
+                          '-dBATCH', '-dNOPAUSE',
+                          '-c', f'({ps_string(path)}) (r) file runpdfbegin pdfpagecount = quit' ])
+    try:
+        return int(out.split()[-1])
+    except Exception as e:
+        raise CommandError(f'Failed to determine the number of pages in "{pdf}" ({e})')
+
+def pdf_page_sizes(pdf):
+    # Returns [ (width, height) ] in points of the pages with /Rotate applied.
+    # ghostscript prints "[MEDIABOX] ROTATE" for each page.
+    with gs_readable(pdf) as path:
+        out = gs_output([ '-q', '-dNODISPLAY', '-dSAFER', f'--permit-file-read={path}',
+                          '-dBATCH', '-dNOPAUSE',
+                          '-c', f'({ps_string(path)}) (r) file runpdfbegin '
+                          '1 1 pdfpagecount { pdfgetpage dup /MediaBox pget pop ==only '
+                          '( ) print /Rotate pget not { 0 } if = } for quit' ])
+    sizes = []
+    for line in out.splitlines():
+        m = re.match(r'^\s*\[([-0-9.e\s]+)\]\s+(-?[0-9]+)\s*$', line)
+        if m is None:
+            continue
+        box = [ float(v) for v in m.group(1).split() ]
+        if len(box) != 4:
+            continue
+        (w, h) = (abs(box[2] - box[0]), abs(box[3] - box[1]))
+        if int(m.group(2)) % 180 != 0:
+            (w, h) = (h, w)
+        sizes.append((w, h))
+    if len(sizes) == 0 or min(min(wh) for wh in sizes) <= 0:
+        raise CommandError(f'Failed to determine the page sizes of "{pdf}"')
+    return sizes
+
+def fit_size(page_size):
+    # Pixel size of a page of page_size points scaled to fit the body like
+    # "convert -resize {size[0]}x{body_height}". None if ghostscript might
+    # rotate the page to fit, i.e. if rounding flipped the orientation.
+    w = page_size[0] * prog_args.dpi / 72
+    h = page_size[1] * prog_args.dpi / 72
+    scale = min(size[0] / w, body_height / h)
+    fit = (max(int(w * scale + 0.5), 1), max(int(h * scale + 0.5), 1))
+    if (fit[0] - fit[1]) * (page_size[0] - page_size[1]) < 0:
+        return None
+    return fit
+
+def split_render_chunks(pages):
+    # Split a document into page ranges so that a large document can be
+    # rendered by multiple ghostscript processes. Each process has to load
+    # the document, so don't go below RENDER_CHUNK_MIN pages per chunk.
+    nr_chunks = min(render_slots,
+                    (len(pages) + RENDER_CHUNK_MIN - 1) // RENDER_CHUNK_MIN)
+    nr_chunks = max(nr_chunks, 1)
+    chunk_len = (len(pages) + nr_chunks - 1) // nr_chunks
+    return [ pages[i:i + chunk_len] for i in range(0, len(pages), chunk_len) ]
+
+def render_pages(pdf, pages, page_done):
+    # pages is an ascending list of pages of pdf which share the same fit.
+    # Render them into chunk-specific files and rename each to the page's
+    # SRC_ file once complete so that chunks can't collide.
+    stem = stem_name(pdf)
+    chunk_file = scratch_file('CHUNK', f'{stem}-{pages[0].nr}-%d')
+    device = 'png16m' if prog_args.intermediate == 'png' else 'ppmraw'
+    args = [ '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dNOPROMPT',
+             '-dMaxBitMap=500000000', '-dAlignToPixels=0', '-dGridFitTT=2',
+             f'-sDEVICE={device}', '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4',
+             f'-r{prog_args.dpi}' ]
+    if pages[0].fit is not None:
+        # scale the pages straight into their fitted size
+        args += [ '-dFIXEDMEDIA', '-dPDFFitPage',
+                  f'-g{pages[0].fit[0]}x{pages[0].fit[1]}' ]
+    nrs = [ page.nr for page in pages ]
+    if nrs[-1] - nrs[0] + 1 == len(nrs):
+        args += [ f'-dFirstPage={nrs[0]}', f'-dLastPage={nrs[-1]}' ]
+    else:
+        # pages not selected are skipped without being interpreted
+        args.append(f'-sPageList={page_list(nrs)}')
+    args += [ f'-sOutputFile={chunk_file}', pdf ]
+
+    # ghostscript prints "Page N" when it starts on page N, at which point
+    # all the preceding pages have been written out.
+    nr_done = 0
+    def on_page_start(nr):
+        nonlocal nr_done
+        while nr_done < min(nr - 1, len(pages)):
+            page = pages[nr_done]
+            os.replace(chunk_file.replace('%d', f'{nr_done + 1}'), page.file)
+            trace_file(page.file)
+            page_done(page)
+            nr_done += 1
+
+    run_gs_pages(args, on_page_start)
+    on_page_start(len(pages) + 1)
+
+def flatten_png(src, dst):
+    # the pdf writer can only take pngs without alpha or interlacing
+    run_convert([ src, '-background', 'white', '-alpha', 'remove',
+                  '-alpha', 'off', '-interlace', 'none', f'PNG24:{dst}' ])
+
+# Thresholds for classify_page(). Fractions are of the body area.
+COLOR_MIN_AREA = 0.001          # pixels with more chroma than 12%
+PHOTO_MIN_AREA = 0.2            # continuous tone areas
+BILEVEL_MAX_SMOOTH = 0.002      # continuous tone areas
+BILEVEL_THRESHOLD = 60          # pixels darker than this % become black
+BILEVEL_MIN_DARK = 0.5          # share of the ink which stays black
+
+def body_crop_args(path):
+    return [ path, '-crop', f'{size[0]}x{body_height}+0+{header_height}', '+repage',
+             '-background', 'white', '-alpha', 'remove', '-alpha', 'off' ]
+
+def classify_page(path):
+    '''
+    Classify the body of the processed page at path by how it's best
+    encoded. 'rgb' and 'gray' are line art which compresses well
+    losslessly, 'bilevel' is black and white line art which loses only
+    anti-aliasing when thresholded and 'photo' and 'gray-photo' have large
+    continuous tone areas better left to jpeg.
+
+    Continuous tone areas are the midtone pixels which survive erosion,
+    which removes the thin midtone fringes of anti-aliased lines and text.
+    '''
+    out = convert_output([ '-respect-parentheses' ] + body_crop_args(path) +
+                         [ '-sample', '50%',
+                           '(', '+clone', '-colorspace', 'HCL', '-channel', 'G',
+                           '-separate', '+channel', '-threshold', '12%',
+                           '-format', '%[fx:mean] ', '-write', 'info:', '+delete', ')',
+                           '-colorspace', 'Gray',
+                           '(', '+clone', '-threshold', f'{BILEVEL_THRESHOLD}%',
+                           '-format', '%[fx:mean] ', '-write', 'info:', '+delete', ')',
+                           '(', '+clone', '-threshold', '90%',
+                           '-format', '%[fx:mean] ', '-write', 'info:', '+delete', ')',
+                           '(', '+clone', '-threshold', '10%', ')',
+                           '(', '-clone', '0', '-threshold', '90%', '-negate', ')',
+                           '-delete', '0', '-compose', 'Multiply', '-composite',
+                           '-morphology', 'Erode', 'Square:1',
+                           '-format', '%[fx:mean]', 'info:' ])
+    (color, light, white, smooth) = (float(v) for v in out.split()[:4])
+    color = color > COLOR_MIN_AREA
+    if smooth >= PHOTO_MIN_AREA:
+        return 'photo' if color else 'gray-photo'
+    if color:
+        return 'rgb'
+    if smooth <= BILEVEL_MAX_SMOOTH and 1 - light >= (1 - white) * BILEVEL_MIN_DARK:
+        return 'bilevel'
+    return 'gray'
+
+def encode_body(page, cls):
+    '''
+    Crop the body out of the processed page and encode it for class cls of
+    classify_page() into the new page.file.
+    '''
+    args = body_crop_args(page.file) + [ '-strip' ]
+    if cls == 'bilevel':
+        dst = f'{scratch_dir}/ENCODED_{page.stem}.tif'
+        args += [ '-colorspace', 'Gray', '-threshold', f'{BILEVEL_THRESHOLD}%',
+                  '-type', 'bilevel', '-compress', 'Group4',
+                  '-define', f'tiff:rows-per-strip={body_height}', f'TIFF:{dst}' ]
+    elif cls == 'gray' and prog_args.intermediate == 'ppm':
+        # deflated by the writer
+        dst = f'{scratch_dir}/ENCODED_{page.stem}.pgm'
+        args += [ '-colorspace', 'Gray', '-depth', '8', f'PGM:{dst}' ]
+    elif cls == 'gray':
+        dst = f'{scratch_dir}/ENCODED_{page.stem}.png'
+        args += [ '-colorspace', 'Gray', '-depth', '8',
+                  '-define', 'png:color-type=0', f'PNG:{dst}' ]
+    else:
+        dst = f'{scratch_dir}/ENCODED_{page.stem}.jpg'
+        if cls == 'gray-photo':
+            args += [ '-colorspace', 'Gray' ]
+        args += [ '-quality', f'{prog_args.jpeg_quality}', f'JPEG:{dst}' ]
+    run_convert(args)
+    release_file(page.file)
+    page.file = dst
+
+# Widths of printable ascii characters of Helvetica-Bold in 1/1000 em
+HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 278, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    278, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584 ]
+
+def text_width(text, pointsize):
+    width = 0
+    for c in text:
+        if 32 <= ord(c) < 127:
+            width += HELVETICA_BOLD_WIDTHS[ord(c) - 32]
+        else:
+            width += 556
+    return width * pointsize / 1000
+
+def color_rgb(color):
+    out = convert_output([ f'xc:{color}', '-format',
+                           '%[fx:r] %[fx:g] %[fx:b]', 'info:' ])
+    return tuple(float(v) for v in out.split()[:3])
+
+def overlay_box(box_size, gravity, margin):
+    # Top-left corner of a box_size overlay composited with -gravity
+    # GRAVITY_Y[gravity] -geometry -XMARGIN+YMARGIN like text_overlay_args().
+    gravity = GRAVITY_Y[gravity]
+    x = (size[0] - box_size[0]) // 2 - margin[0]
+    if gravity == 'north':
+        y = margin[1]
+    elif gravity == 'center':
+        y = (size[1] - box_size[1]) // 2 + margin[1]
+    else:
+        y = size[1] - box_size[1] - margin[1]
+    return (x, y)
+
+def vector_text(text, height, color, gravity, margin):
+    # Emulate the label image which is size[0] x height pixels with the
+    # text aligned to GRAVITY_X[gravity] and centered vertically. The
+    # pointsize is chosen so that the font's ascent + descent fills the
+    # height like "label:" does.
+    px_to_pt = 72 / prog_args.dpi
+    (box_x, box_y) = overlay_box((size[0], height), gravity, margin)
+    box_w = size[0] * px_to_pt
+    box_h = height * px_to_pt
+
+    pointsize = box_h / 1.164
+    width = text_width(text, pointsize)
+    if width > box_w:
+        pointsize *= box_w / width
+        width = box_w
+
+    x = box_x * px_to_pt
+    if GRAVITY_X[gravity] == 'center':
+        x += (box_w - width) / 2
+    elif GRAVITY_X[gravity] == 'east':
+        x += box_w - width
+    bottom = (size[1] - box_y - height) * px_to_pt
+    y = bottom + (box_h - 1.164 * pointsize) / 2 + 0.236 * pointsize
+
+    return (f'BT /F1 {pointsize:.3f} Tf {color[0]:.3f} {color[1]:.3f} {color[2]:.3f} rg '
+            f'{x:.3f} {y:.3f} Td ({pdf_string(text)}) Tj ET\n')
+
+def pdf_string(text):
+    # text escaped for a pdf string in WinAnsiEncoding, as a latin-1 str
+    text = text.encode('cp1252', 'replace')
+    text = text.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+    return text.decode('latin-1')
+
+def write_vector_pdf(docs, output_path):
+    try:
+        import pypdf
+    except ImportError:
+        err('--vector requires pypdf, install it with "pip install pypdf"')
+
+    px_to_pt = 72 / prog_args.dpi
+    page_w = size[0] * px_to_pt
+    page_h = size[1] * px_to_pt
+
+    # Write the header, footer, labels and numbers of all pages into the
+    # frame pdf and then merge the source pages into the body area.
+    frame_path = f'{tempdir}/__FRAME__.pdf'
+    frame = PdfWriter(frame_path, prog_args.dpi)
+    font_nr = frame.add_font('Helvetica-Bold')
+
+    header_content = ''
+    xobjects = {}
+    for (name, path, y, height) in [ ('Hdr', header_file, 0, header_height),
+                                     ('Ftr', footer_file, size[1] - footer_height,
+                                      footer_height) ]:
+        if path is None:
+            continue
+        if png_info(path) is None:
+            flatten_png(path, f'{path}.flat.png')
+            path = f'{path}.flat.png'
+        (xobjects[name], img_w, img_h) = frame.add_image(path)
+        header_content += (f'q {page_w:.4f} 0 0 {height * px_to_pt:.4f} 0 '
+                           f'{(size[1] - y - height) * px_to_pt:.4f} cm /{name} Do Q\n')
+
+    label_color = color_rgb(prog_args.label_color)
+    number_color = color_rgb(prog_args.number_color)
+
+    for (pdf, doc_pages) in docs:
+        for page in doc_pages:
+            content = header_content
+            if prog_args.label_sep is not None:
+                content += vector_text(page.label,
+                                       label_height, label_color,
+                                       prog_args.label_gravity, label_margin)
+            if page.number is not None:
+                content += vector_text(f'{page.number}', number_height, number_color,
+                                       prog_args.number_gravity, number_margin)
+            frame.add_page_content(page.idx, page_w, page_h, content,
+                                   xobjects=xobjects, fonts={ 'F1': font_nr })
+    frame.close()
+
+    frame_reader = pypdf.PdfReader(frame_path)
+    writer = pypdf.PdfWriter()
+    body_w = size[0] * px_to_pt
+    body_h = body_height * px_to_pt
+    body_y = footer_height * px_to_pt
+
+    for (pdf, doc_pages) in docs:
+        info(f'Placing "{stem_name(pdf)}"...')
+        reader = pypdf.PdfReader(pdf)
+        for page in doc_pages:
+            src = reader.pages[page.nr - 1]
+            src.transfer_rotation_to_content()
+            box = src.mediabox
+            scale = min(body_w / float(box.width), body_h / float(box.height))
+            tx = (body_w - float(box.width) * scale) / 2
+            ty = body_y + (body_h - float(box.height) * scale) / 2
+            ctm = (pypdf.Transformation()
+                   .translate(-float(box.left), -float(box.bottom))
+                   .scale(scale, scale)
+                   .translate(tx, ty))
+
+            dst = writer.add_page(frame_reader.pages[page.idx])
+            dst.merge_transformed_page(src, ctm, over=False)
+
+    info(f'Writing "{output_path}"...')
+    with open(output_path, 'wb') as f:
+        writer.write(f)
+
+def part_path(path, nr):
+    (base, ext) = os.path.splitext(path)
+    return f'{base}-part{nr:03d}{ext}'
+
+def index_path(path):
+    return f'{os.path.splitext(path)[0]}.index.{prog_args.split_index}'
+
+def output_exists(path):
+    # Whether building into path would overwrite an earlier output. A split
+    # output is identified by its first part and index.
+    if not splitting:
+        return os.path.exists(path)
+    return (os.path.exists(part_path(path, 1)) or
+            (prog_args.split_index is not None and os.path.exists(index_path(path))))
+
+def split_parts(pages, writer=None):
+    '''
+    Split pages in output order into parts of at most --split-pages pages
+    and, by the sizes of the objects in writer, at most --split-size bytes.
+    Images shared by pages are counted once per part. With --split-labels,
+    each label starts a new part. A page which doesn't fit in --split-size
+    by itself gets a part of its own.
+    '''
+    parts = [ [] ]
+    objs = set()
+    nr_bytes = PdfWriter.PART_OVERHEAD
+    for page in pages:
+        page_objs = set()
+        if split_size is not None:
+            page_objs = writer.page_objects(page.idx)
+        part = parts[-1]
+        if len(part) > 0 and (
+                (prog_args.split_pages is not None and len(part) >= prog_args.split_pages) or
+                (prog_args.split_labels and page.label != part[-1].label) or
+                (split_size is not None and
+                 nr_bytes + writer.objects_size(page_objs - objs) > split_size)):
+            parts.append([])
+            objs = set()
+            nr_bytes = PdfWriter.PART_OVERHEAD
+        if split_size is not None:
+            nr_bytes += writer.objects_size(page_objs - objs) + PdfWriter.PAGE_ENTRY
+        parts[-1].append(page)
+        objs |= page_objs
+    return parts
+
+def run_qpdf(args):
+    # qpdf exits with 3 if it succeeded with warnings
+    cmd = [ QPDF_BIN, '--warning-exit-0' ] + args
+    try:
+        run_command('qpdf', cmd, capture=False)
+    except Exception as e:
+        raise CommandError(f'qpdf command ({cmd}) failed ({e})')
+    trace_file(args[-1])
+
+def linearize_pdf(path):
+    info(f'Linearizing "{path}"...')
+    with trace_span('linearize', path):
+        run_qpdf([ '--linearize', path, f'{path}.tmp' ])
+    os.replace(f'{path}.tmp', path)
+
+def write_stream_part(writer, pages, path):
+    # copy pages of the closed writer into the part at path
+    info(f'Writing "{path}"...')
+    if prog_args.linearize:
+        # qpdf copies and linearizes the pages in one pass
+        run_qpdf([ '--linearize', '--empty', '--pages', writer.path,
+                   page_list([ page.idx + 1 for page in pages ]), '--', f'{path}.tmp' ])
+        os.replace(f'{path}.tmp', path)
+    else:
+        writer.write_part([ page.idx for page in pages ], path)
+
+def collect_pages(pages, path):
+    # collect the processed pages into path with a single convert command
+    args = [ '-format', 'pdf',
+             '-resize', f'{size[0]}x{size[1]}',
+             '-units', 'PixelsPerInch',
+             '-density', f'{prog_args.dpi}' ]
+    args += [ page.file for page in pages ]
+    if prog_args.linearize:
+        args.append(f'PDF:{path}.tmp')
+    else:
+        args.append(path)
+
+    info(f'Collecting annotated pages into "{path}"...')
+    with trace_span('collect', path):
+        run_convert(args)
+    if prog_args.linearize:
+        with trace_span('linearize', path):
+            run_qpdf([ '--linearize', f'{path}.tmp', path ])
+        os.unlink(f'{path}.tmp')
+
+def wrap_text(text, pointsize, width):
+    # split text into lines of Helvetica-Bold at pointsize fitting width
+    lines = []
+    for word in text.split(' '):
+        if len(lines) > 0 and text_width(f'{lines[-1]} {word}', pointsize) <= width:
+            lines[-1] += f' {word}'
+        else:
+            lines.append(word)
+    return lines
+
+def write_index_pdf(path, title, entries):
+    # A line for each part followed by its labels, on pages of the paper size.
+    w = paper_size[0] / MM_PER_IN * 72
+    h = paper_size[1] / MM_PER_IN * 72
+    margin = 36
+    lines = [ (14, title) ]
+    for entry in entries:
+        line = f'{entry["file"]}   pages {entry["pages"][0]}-{entry["pages"][1]}'
+        if entry['numbers'] is not None:
+            line += f'   numbers {entry["numbers"][0]}-{entry["numbers"][1]}'
+        lines.append((11, line))
+        lines += [ (9, text) for text in wrap_text(', '.join(entry['labels']), 9,
+                                                   w - 2 * margin - 18)
+                   if text != '' ]
+
+    writer = PdfWriter(path, 72)
+    font_nr = writer.add_font('Helvetica-Bold')
+    nr_pages = 0
+    content = ''
+    y = h - margin
+    for (pointsize, text) in lines:
+        if y - pointsize * 1.4 < margin:
+            writer.add_page_content(nr_pages, w, h, content, fonts={ 'F1': font_nr })
+            nr_pages += 1
+            content = ''
+            y = h - margin
+        y -= pointsize * 1.4
+        x = margin if pointsize > 9 else margin + 18
+        content += f'BT /F1 {pointsize} Tf {x} {y:.2f} Td ({pdf_string(text)}) Tj ET\n'
+    writer.add_page_content(nr_pages, w, h, content, fonts={ 'F1': font_nr })
+    writer.close()
+
+def write_split_index(parts, paths):
+    '''
+    Write the --split-index of parts, lists of pages, written into paths.
+    Each part is listed with its file name, its first and last page in the
+    whole output, its labels and its first and last page number.
+    '''
+    entries = []
+    for (part, path) in zip(parts, paths):
+        numbers = [ page.number for page in part if page.number is not None ]
+        entries.append({
+            'file': os.path.basename(path),
+            'pages': [ part[0].idx + 1, part[-1].idx + 1 ],
+            'labels': list(dict.fromkeys(page.label for page in part
+                                         if page.label is not None)),
+            'numbers': [ numbers[0], numbers[-1] ] if len(numbers) > 0 else None })
+
+    path = index_path(output_path)
+    if prog_args.split_index == 'json':
+        with open(path, 'w') as f:
+            json.dump({ 'output': os.path.basename(output_path), 'parts': entries },
+                      f, indent=2)
+    else:
+        write_index_pdf(path, f'{os.path.basename(output_path)}: {len(parts)} parts',
+                        entries)
+    info(f'Index of the parts written into "{path}"')
+
+def write_parts(parts, write_fn):
+    '''
+    Write parts, lists of pages, into part_path(output_path, NR) in parallel
+    with write_fn(pages, path). Parts of an earlier output which are beyond
+    the new last part are removed.
+    '''
+    paths = [ part_path(output_path, i + 1) for i in range(len(parts)) ]
+    for (part, path) in zip(parts, paths):
+        pool.submit(f'writing "{path}"', lambda arg: write_fn(*arg), (part, path),
+                    cost=len(part))
+    check_failures(pool.wait())
+
+    nr = len(parts) + 1
+    while os.path.exists(part_path(output_path, nr)):
+        dbg(f'Removing stale "{part_path(output_path, nr)}"')
+        os.unlink(part_path(output_path, nr))
+        nr += 1
+
+    if prog_args.split_index is not None:
+        write_split_index(parts, paths)
+    info(f'Output split into {len(parts)} parts "{paths[0]}" to "{paths[-1]}"')
+
+def parse_size(s):
+    units = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+    s = s.strip().upper().rstrip('B')
+    if len(s) > 0 and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if len(data) == 0:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def cache_key(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+# Pages are cached under --cache-dir by the hash of everything which
+# affects them. "src" entries are rendered pages keyed by the source pdf
+# content, page number and dpi. "page" entries are fully processed pages
+# keyed by the src key and all processing options.
+def cache_path(kind, key):
+    return f'{prog_args.cache_dir}/{kind}/{key[:2]}/{key}.{prog_args.intermediate}'
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def cache_get(kind, key, dst):
+    if prog_args.cache_dir is None or key is None:
+        return False
+    path = cache_path(kind, key)
+    try:
+        # mtime is used as the last use time for eviction
+        os.utime(path)
+        link_or_copy(path, dst)
+    except OSError:
+        return False
+    ddbg(f'cache hit {kind} {key} -> {dst}')
+    return True
+
+def cache_put(kind, key, src):
+    if prog_args.cache_dir is None or key is None:
+        return
+    path = cache_path(kind, key)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    link_or_copy(src, tmp)
+    os.replace(tmp, path)
+
+def cache_files():
+    files = []
+    for kind in ('src', 'body', 'page'):
+        for path in (glob.glob(f'{prog_args.cache_dir}/{kind}/*/*.png') +
+                     glob.glob(f'{prog_args.cache_dir}/{kind}/*/*.ppm')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+    return files
+
+def evict_cache(max_size):
+    files = sorted(cache_files())
+    total = sum(f[1] for f in files)
+    nr_evicted = 0
+    for (mtime, fsize, path) in files:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= fsize
+        nr_evicted += 1
+    dbg(f'cache: evicted {nr_evicted} files, {total} bytes left')
+
+def clear_cache():
+    info(f'Clearing cache "{prog_args.cache_dir}"...')
+    for kind in ('src', 'body', 'page'):
+        shutil.rmtree(f'{prog_args.cache_dir}/{kind}', ignore_errors=True)
+
+class Journal:
+    '''
+    Record of the intermediate page files completed in --tempdir so that an
+    interrupted run can be continued with --resume. Each line is a JSON
+    object with the stage, the page's key for the stage, which covers the
+    source page and every option affecting it, and the path, size and mtime
+    of the file. A line is written only after its file is complete, so a
+    torn last line is ignored when loading.
+    '''
+    def __init__(self, path, resume):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if resume:
+            self.load()
+        self.f = open(path, 'a' if resume else 'w')
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            info(f'No journal found in "{tempdir}", starting from scratch')
+            return
+        for line in lines:
+            try:
+                e = json.loads(line)
+                self.entries[(e['stage'], e['key'])] = (e['file'], e['size'], e['mtime'])
+            except (ValueError, KeyError, TypeError):
+                dbg(f'ignoring broken journal line {line!r}')
+        dbg(f'loaded {len(self.entries)} journal entries')
+
+    def get(self, stage, key):
+        # the file must still be there as it was when recorded
+        entry = self.entries.get((stage, key))
+        if entry is None:
+            return None
+        (path, nr_bytes, mtime) = entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != nr_bytes or st.st_mtime_ns != mtime:
+            dbg(f'journaled "{path}" changed, ignoring')
+            return None
+        return path
+
+    def put(self, stage, key, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        line = json.dumps({ 'stage': stage, 'key': key, 'file': path,
+                            'size': st.st_size, 'mtime': st.st_mtime_ns })
+        with self.lock:
+            self.entries[(stage, key)] = (path, st.st_size, st.st_mtime_ns)
+            self.f.write(line + '\n')
+            self.f.flush()
+
+def journal_get(stage, key):
+    if journal is None or key is None:
+        return None
+    return journal.get(stage, key)
+
+def journal_put(stage, key, path):
+    if journal is not None and key is not None:
+        journal.put(stage, key, path)
+
+def scratch_file(prefix, stem):
+    return f'{scratch_dir}/{prefix}_{stem}.{prog_args.intermediate}'
+
+def setup_scratch_dir(nr_pages):
+    # Put the intermediate page files on /dev/shm if it can hold all the
+    # pages uncompressed, which is the worst case when rendering runs ahead
+    # of processing. Otherwise, fall back to the temporary directory.
+    global scratch_dir, shm_tempdir_obj
+    if (prog_args.scratch_dir is not None or prog_args.tempdir is not None or
+        prog_args.vector):
+        return
+    need = size[0] * size[1] * 3 * nr_pages
+    try:
+        free = shutil.disk_usage('/dev/shm').free
+    except OSError:
+        free = 0
+    if free >= need * 2:
+        if shm_tempdir_obj is None:
+            shm_tempdir_obj = tempfile.TemporaryDirectory(dir='/dev/shm')
+        scratch_dir = shm_tempdir_obj.name
+    else:
+        scratch_dir = tempdir
+    dbg(f'scratch_dir={scratch_dir} need={need} free={free}')
+
+def scratch_usage():
+    # scratch files are flat in scratch_dir, the cache is in a subdirectory
+    total = 0
+    try:
+        with os.scandir(scratch_dir) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return total
+
+def available_memory():
+    # MemAvailable on linux, free physical memory elsewhere, None if unknown
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Rough per-job estimates for admission control. ImageMagick's pixel cache
+# takes 8 bytes per pixel (Q16 RGBA) and a processing command holds about
+# three page-sized images, e.g. the body, the appended page and the result.
+# ghostscript holds the page bitmap on top of the interpreter.
+MAGICK_PIXEL_BYTES = 8
+GS_BASE_MEM = 64 << 20
+
+def page_job_mem():
+    pixels = size[0] * size[1]
+    if prog_args.backend == 'pillow':
+        # uint8 canvas and body plus the float32 overlay blending
+        return pixels * 3 * 4
+    return pixels * MAGICK_PIXEL_BYTES * 3
+
+def render_job_mem():
+    return size[0] * size[1] * 3 + GS_BASE_MEM
+
+def page_scratch_bytes():
+    # png pages of documents usually compress to well below a quarter
+    raw = size[0] * size[1] * 3
+    return raw if prog_args.intermediate == 'ppm' else raw // 4
+
+def release_file(path):
+    # keep everything around if --tempdir is specified for debugging
+    if prog_args.tempdir is None:
+        os.unlink(path)
+
+def run_convert_batch(items):
+    '''
+    Run items, a list of (args, dst) where args produce a single image to be
+    written to dst. A single item is run by itself. Multiple items are run
+    by one convert process, which saves the process startup and
+    initialization for all but the first. Each item is isolated in
+    parentheses and its result is written out and dropped before the next.
+    The last item's result is left as the command's output, as convert
+    fails if there's no image left to write at the end.
+    '''
+    if len(items) == 1:
+        run_convert([ '-respect-parentheses' ] + items[0][0] + [ items[0][1] ])
+        return
+    args = [ '-respect-parentheses' ]
+    for (item_args, dst) in items[:-1]:
+        args += [ '(' ] + item_args + [ '-write', dst, ')', '+delete' ]
+    (item_args, dst) = items[-1]
+    run_convert(args + [ '(' ] + item_args + [ ')', dst ])
+    for (item_args, dst) in items[:-1]:
+        trace_file(dst)
+
+def batch_desc(pages):
+    if len(pages) == 1:
+        return pages[0].stem
+    return f'{pages[0].stem} and {len(pages) - 1} more'
+
+def text_args(src_file, atlas, text, height, gravity, margin):
+    return [ src_file ] + text_overlay_args(atlas, text, height, gravity, margin)
+
+def process_pages_staged(pages):
+    # Resize to body_height. Pages which ghostscript rendered at their fitted
+    # size only need to be centered, which is folded into the merge if any.
+    extent = [ '-gravity', 'center', '-extent', f'{size[0]}x{body_height}' ]
+    merge = header_file is not None or footer_file is not None
+    items = []
+    body_args = {}
+    for page in pages:
+        if page.fit is None or not merge:
+            args = [ page.file, '-strip' ]
+            if page.fit is None:
+                info(f'Resizing "{page.stem}"...')
+                args += [ '-resize', f'{size[0]}x{body_height}' ]
+            else:
+                info(f'Centering "{page.stem}"...')
+            items.append((page, args + extent, scratch_file('RESIZED', page.stem)))
+        else:
+            body_args[page] = [ '(', page.file, '-strip' ] + extent + [ ')' ]
+    run_page_items('resize', items)
+    for (page, args, dst) in items:
+        body_args[page] = [ page.file ]
+
+    # merge header and footer
+    if merge:
+        items = []
+        for page in pages:
+            args = []
+            if header_file is not None:
+                args.append(header_file)
+            args += body_args[page]
+            if footer_file is not None:
+                args.append(footer_file)
+            info(f'Merging "{page.stem}"...')
+            items.append((page, args + [ '-append', '-strip' ],
+                          scratch_file('MERGED', page.stem)))
+        run_page_items('merge', items)
+
+    # label, drawn as an overlay by the writer for layered output
+    items = []
+    for page in pages:
+        if page.label is not None and not layered:
+            info(f'Labeling "{page.stem}"...')
+            items.append((page, text_args(page.file, label_atlas, page.label,
+                                          label_height, prog_args.label_gravity,
+                                          label_margin),
+                          scratch_file('LABELED', page.stem)))
+    run_page_items('label', items)
+
+def number_pages(pages):
+    items = []
+    for page in pages:
+        if page.number is not None and not layered:
+            info(f'Numbering "{page.stem}"...')
+            items.append((page, text_args(page.file, number_atlas, f'{page.number}',
+                                          number_height, prog_args.number_gravity,
+                                          number_margin),
+                          scratch_file('NUMBERED', page.stem)))
+    run_page_items('number', items)
+
+def run_page_items(stage, items):
+    # run a stage for a batch of (page, args, dst) and move the pages to dst
+    if len(items) == 0:
+        return
+    with trace_span(stage, batch_desc([ page for (page, args, dst) in items ])):
+        run_convert_batch([ (args, dst) for (page, args, dst) in items ])
+    for (page, args, dst) in items:
+        release_file(page.file)
+        page.file = dst
+
+def fused_args(src_file, label, number, fitted=False):
+    # Settings inside parentheses must not leak into the following
+    # operations, e.g. the label gravity into the overlay placement, so
+    # these must be run with -respect-parentheses.
+    args = []
+    if header_file is not None:
+        args.append(header_file)
+    args += [ '(', src_file, '-strip' ]
+    if not fitted:
+        args += [ '-resize', f'{size[0]}x{body_height}' ]
+    args += [ '-gravity', 'center', '-extent', f'{size[0]}x{body_height}', ')' ]
+    if footer_file is not None:
+        args.append(footer_file)
+    if header_file is not None or footer_file is not None:
+        args.append('-append')
+
+    if label is not None:
+        args += text_overlay_args(label_atlas, label, label_height,
+                                  prog_args.label_gravity, label_margin)
+    if number is not None:
+        args += text_overlay_args(number_atlas, f'{number}', number_height,
+                                  prog_args.number_gravity, number_margin)
+    return args + [ '-strip' ]
+
+def process_pages_fused(pages):
+    items = []
+    for page in pages:
+        info(f'Processing "{page.stem}"...')
+        if layered:
+            args = fused_args(page.file, None, None, page.fit is not None)
+        else:
+            args = fused_args(page.file, page.label, page.number, page.fit is not None)
+        items.append((page, args, scratch_file('FUSED', page.stem)))
+    run_page_items('fused', items)
+
+def import_pillow():
+    global np, Image
+    try:
+        import numpy as np
+        from PIL import Image
+    except ImportError:
+        err('--backend pillow requires numpy and Pillow, '
+            'install them with "pip install numpy pillow"')
+
+# Decoded header, footer and label images which are used for every page
+image_arrays = {}
+image_arrays_lock = threading.Lock()
+
+def load_rgb(path):
+    with image_arrays_lock:
+        if path in image_arrays:
+            return image_arrays[path]
+    with Image.open(path) as im:
+        if 'A' in im.getbands() or im.mode == 'P':
+            im = im.convert('RGBA')
+            bg = Image.new('RGBA', im.size, 'white')
+            bg.alpha_composite(im)
+            im = bg
+        arr = np.asarray(im.convert('RGB'))
+    with image_arrays_lock:
+        image_arrays[path] = arr
+    return arr
+
+def load_overlay(path):
+    # returns (rgb, alpha) as float32 arrays, alpha is in [0, 1]
+    with image_arrays_lock:
+        if path in image_arrays:
+            return image_arrays[path]
+    with Image.open(path) as im:
+        arr = np.asarray(im.convert('RGBA'), dtype=np.float32)
+    overlay = (arr[:, :, :3], arr[:, :, 3:] / 255)
+    with image_arrays_lock:
+        image_arrays[path] = overlay
+    return overlay
+
+def blend_overlay(canvas, overlay, pos):
+    # alpha-composite overlay over canvas with its top-left corner at pos
+    (rgb, alpha) = overlay
+    (x, y) = pos
+    (h, w) = alpha.shape[:2]
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + w, canvas.shape[1])
+    y1 = min(y + h, canvas.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    a = alpha[y0 - y:y1 - y, x0 - x:x1 - x]
+    c = rgb[y0 - y:y1 - y, x0 - x:x1 - x]
+    region = canvas[y0:y1, x0:x1]
+    canvas[y0:y1, x0:x1] = (region * (1 - a) + c * a + 0.5).astype(np.uint8)
+
+def blend_text(canvas, atlas, text, height, gravity, margin):
+    # compose text from the glyphs and place it like text_overlay_args()
+    if len(text) == 0:
+        return
+    glyphs = [ load_overlay(path) for path in atlas.files(text) ]
+    rgb = np.hstack([ g[0] for g in glyphs ])
+    alpha = np.hstack([ g[1] for g in glyphs ])
+    if alpha.shape[1] > size[0]:
+        # shrink text wider than the page like text_image_args()
+        h = max(int(alpha.shape[0] * size[0] / alpha.shape[1] + 0.5), 1)
+        im = Image.fromarray((np.dstack((rgb, alpha * 255)) + 0.5).astype(np.uint8), 'RGBA')
+        arr = np.asarray(im.resize((size[0], h), Image.LANCZOS), dtype=np.float32)
+        (rgb, alpha) = (arr[:, :, :3], arr[:, :, 3:] / 255)
+
+    (x, y) = overlay_box((size[0], height), gravity, margin)
+    if GRAVITY_X[gravity] == 'center':
+        x += (size[0] - alpha.shape[1]) // 2
+    elif GRAVITY_X[gravity] == 'east':
+        x += size[0] - alpha.shape[1]
+    y += (height - alpha.shape[0]) // 2
+    blend_overlay(canvas, (rgb, alpha), (x, y))
+
+def process_page_pillow(page):
+    # equivalent to process_pages_fused() with the images kept in memory
+    info(f'Processing "{page.stem}"...')
+    with Image.open(page.file) as im:
+        im = im.convert('RGB')
+        scale = min(size[0] / im.width, body_height / im.height)
+        w = max(int(im.width * scale + 0.5), 1)
+        h = max(int(im.height * scale + 0.5), 1)
+        if (w, h) != im.size:
+            im = im.resize((w, h), Image.LANCZOS)
+        body = np.full((body_height, size[0], 3), 255, dtype=np.uint8)
+        x = (size[0] - w) // 2
+        y = (body_height - h) // 2
+        body[y:y + h, x:x + w] = np.asarray(im)
+
+    parts = [ body ]
+    if header_file is not None:
+        parts.insert(0, load_rgb(header_file))
+    if footer_file is not None:
+        parts.append(load_rgb(footer_file))
+    canvas = np.vstack(parts) if len(parts) > 1 else body
+
+    if page.label is not None and not layered:
+        blend_text(canvas, label_atlas, page.label, label_height,
+                   prog_args.label_gravity, label_margin)
+    if page.number is not None and not layered:
+        blend_text(canvas, number_atlas, f'{page.number}', number_height,
+                   prog_args.number_gravity, number_margin)
+
+    dst = scratch_file('PROCESSED', page.stem)
+    Image.fromarray(canvas).save(dst)
+    trace_file(dst)
+    release_file(page.file)
+    page.file = dst
+
+def process_pages(pages, body_done=None):
+    # Process rendered pages with the configured backend. body_done is
+    # called for each page whose unnumbered body is available, for caching.
+    if prog_args.backend == 'pillow':
+        for page in pages:
+            process_page_pillow(page)
+    elif prog_args.fused:
+        process_pages_fused(pages)
+    else:
+        process_pages_staged(pages)
+        if body_done is not None:
+            for page in pages:
+                body_done(page)
+        number_pages(pages)
+
+# a source file followed by a page selection, e.g. "cutsheet.pdf[1-3,7]"
+SOURCE_SELECTION_RE = re.compile(r'^(.+)\[([0-9,\s-]*)\]$')
+
+def find_pdfs():
+    '''
+    Return the source pdfs and set page_selections to the page ranges
+    selected for them on the command line or in their sidecar files.
+    '''
+    global page_selections
+    pdfs = []
+    page_selections = {}
+    nr_selected = collections.Counter()
+    for src in prog_args.src:
+        if not os.path.exists(src):
+            m = SOURCE_SELECTION_RE.match(src)
+            if m is not None and os.path.isfile(m.group(1)):
+                pdf = m.group(1)
+                try:
+                    ranges = parse_page_selection(m.group(2))
+                except Exception as e:
+                    err(f'Invalid page selection "{src}" ({e})')
+                # selections are per file, so a file can't be listed twice
+                # with different ones
+                if page_selections.get(pdf, ranges) != ranges:
+                    err(f'"{pdf}" is given with different page selections')
+                page_selections[pdf] = ranges
+                nr_selected[pdf] += 1
+                pdfs.append(pdf)
+                continue
+        if os.path.isdir(src):
+            pdfs += sorted_mixed_basename(glob.glob(f'{src}/*.pdf'))
+            continue
+        elif os.path.isfile(src):
+            pdfs.append(src)
+            continue
+        elif is_windows() and len(src) and src[-1] == '"':
+            # When run through windows powershell, quoting somehow can get
+            # broken and source may end up with a trailing extra double quote.
+            src = src[:-1]
+            if os.path.isdir(src):
+                pdfs += sorted_mixed_basename(glob.glob(f'{src}/*.pdf'))
+                continue
+            elif os.path.isfile(src):
+                pdfs.append(src)
+                continue
+
+        err(f'Invalid source file/dir "{src}"')
+
+    for (pdf, nr) in nr_selected.items():
+        if pdfs.count(pdf) > nr:
+            err(f'"{pdf}" is given both with and without a page selection')
+
+    # the pages of the pdfs without selection on the command line can be
+    # selected in their sidecar files, e.g. "cutsheet.pages" for
+    # "cutsheet.pdf", in the same format with "#" comments
+    for pdf in pdfs:
+        sidecar = sidecar_path(pdf)
+        if pdf in page_selections or not os.path.isfile(sidecar):
+            continue
+        try:
+            with open(sidecar) as f:
+                spec = ' '.join(line.split('#', 1)[0] for line in f)
+            page_selections[pdf] = parse_page_selection(spec)
+        except Exception as e:
+            err(f'Invalid page selection in "{sidecar}" ({e})')
+
+    if not prog_args.keep_order:
+        pdfs = sorted_mixed_basename(pdfs)
+    return pdfs
+
+def source_state(pdfs):
+    state = {}
+    for pdf in pdfs:
+        st = os.stat(pdf)
+        state[pdf] = (st.st_mtime_ns, st.st_size, page_selections.get(pdf))
+    return state
+
+def watch(pdfs):
+    # Poll the sources and rebuild on changes. Unchanged pages come from the
+    # cache, so only the pages of changed files are rendered and processed.
+    state = source_state(pdfs)
+    info(f'Watching {len(pdfs)} pdfs for changes, press Ctrl-C to exit...')
+    while True:
+        time.sleep(prog_args.watch_interval)
+        try:
+            new_pdfs = find_pdfs()
+            new_state = source_state(new_pdfs)
+            if new_state == state:
+                continue
+            # wait for the files to settle, e.g. while being copied
+            time.sleep(prog_args.watch_interval)
+            if source_state(find_pdfs()) != new_state:
+                continue
+        except (OSError, SystemExit):
+            continue
+
+        for pdf in new_pdfs:
+            if pdf not in state:
+                info(f'"{pdf}" added')
+            elif state[pdf] != new_state[pdf]:
+                info(f'"{pdf}" changed')
+        for pdf in state:
+            if pdf not in new_state:
+                info(f'"{pdf}" removed')
+
+        state = new_state
+        try:
+            build(new_pdfs)
+        except SystemExit:
+            warn('Build failed, waiting for further changes...')
+
+def resized_header(src, height):
+    # resized header and footer images are reused across --serve jobs
+    st = os.stat(src)
+    key = (os.path.abspath(src), st.st_mtime_ns, st.st_size, size[0], height,
+           prog_args.intermediate)
+    if key not in resized_headers:
+        dst = f'{tempdir}/__HEADER{len(resized_headers)}__.png'
+        try:
+            resize_header(src, dst, (size[0], height))
+        except CommandError as e:
+            err(e)
+        resized_headers[key] = dst
+    return resized_headers[key]
+
+def glyph_atlas(name, font, height, color):
+    key = (name, font, height, color)
+    if key not in glyph_atlases:
+        glyph_atlases[key] = GlyphAtlas(name, font, height, color)
+    return glyph_atlases[key]
+
+def configure():
+    '''
+    Determine the geometry, header and footer, annotations and output path
+    from prog_args. Called once, or for each job with --serve.
+    '''
+    global paper_size, size, label_margin, number_start, number_margin
+    global header_height, footer_height, body_height, label_height, number_height
+    global magick_limit_args, header_file, footer_file, output_path
+    global label_atlas, number_atlas, layered, promote_args
+    global splitting, split_size
+
+    if prog_args.backend == 'pillow':
+        import_pillow()
+
+    # A proof runs at a low resolution. Everything is sized from the paper
+    # size and dpi, so the layout matches the full resolution output. The
+    # per-page command overhead dominates at low resolutions, so pages are
+    # processed fused in batches.
+    promote_args = None
+    if prog_args.proof:
+        promote_args = job_options_argv()
+        prog_args.dpi = prog_args.proof_dpi
+        prog_args.fused = True
+        prog_args.batch = True
+
+    # parse paper size
+    try:
+        paper_size = prog_args.size.split('x', 2)
+        paper_size = (float(paper_size[0]), float(paper_size[1]))
+        if paper_size[0] <= 0 or paper_size[1] <= 0:
+            raise Exception('must be positive')
+    except Exception as e:
+        err(f'--size must be in the format WIDTHxHEIGHT ({e})')
+
+    # convert that to pixel size based on the dpi
+    size = (int(paper_size[0] / MM_PER_IN * prog_args.dpi),
+            int(paper_size[1] / MM_PER_IN * prog_args.dpi))
+
+    # parse label margin
+    try:
+        label_margin = prog_args.label_margin.split('x', 2)
+        label_margin = (int(size[0] * float(label_margin[0]) / 100),
+                        int(size[1] * float(label_margin[1]) / 100))
+    except Exception as e:
+        err(f'--label-margin must be in the format XPCTxYPCT ({e})')
+
+    # parse number start
+    if prog_args.number_start is None:
+        number_start = None
+    else:
+        try:
+            number_start = int(prog_args.number_start)
+        except Exception as e:
+            err(f'--number-start must be an integer ({e})')
+
+    # parse number margin
+    try:
+        number_margin = prog_args.number_margin.split('x', 2)
+        number_margin = (int(size[0] * float(number_margin[0]) / 100),
+                         int(size[1] * float(number_margin[1]) / 100))
+    except Exception as e:
+        err(f'--label-margin must be in the format XPCTxYPCT ({e})')
+
+    # determine header, content and footer sizes
+    header_height = 0
+    footer_height = 0
+
+    if prog_args.header is not None:
+        header_height = int(size[1] * prog_args.header_height / 100.0)
+
+    if prog_args.footer is not None:
+        footer_height = int(size[1] * prog_args.footer_height / 100.0)
+
+    body_height = size[1] - header_height - footer_height
+    label_height = int(size[1] * prog_args.label_height / 100)
+    number_height = int(size[1] * prog_args.number_height / 100)
+
+    info(f'paper={paper_size[0]}x{paper_size[1]} pixels={size[0]}x{size[1]} '
+         f'header:body:footer={header_height}:{body_height}:{footer_height}')
+
+    if header_height < 0 or body_height < 0 or footer_height < 0:
+        err('Some heights came out negative')
+
+    if prog_args.dedupe and (prog_args.assemble != 'stream' or prog_args.vector):
+        err('--dedupe requires --assemble stream and can\'t be used with --vector')
+    if prog_args.encoding != 'rgb' and (prog_args.assemble != 'stream' or prog_args.vector):
+        err('--encoding requires --assemble stream and can\'t be used with --vector')
+    if prog_args.workers is not None and prog_args.vector:
+        err('--workers can\'t be used with --vector')
+
+    # parse the output splitting
+    split_size = None
+    if prog_args.split_size is not None:
+        try:
+            split_size = parse_size(prog_args.split_size)
+            if split_size <= 0:
+                raise Exception('must be positive')
+        except Exception as e:
+            err(f'--split-size must be a number optionally followed by K, M, G or T ({e})')
+        if prog_args.assemble != 'stream':
+            err('--split-size requires --assemble stream')
+    if prog_args.split_pages is not None and prog_args.split_pages <= 0:
+        err('--split-pages must be positive')
+    if prog_args.split_labels and prog_args.label_sep is None:
+        err('--split-labels requires --label-sep')
+    splitting = (prog_args.split_pages is not None or split_size is not None or
+                 prog_args.split_labels)
+    if splitting and prog_args.vector:
+        err('The output can\'t be split with --vector')
+    if prog_args.split_index is not None and not splitting:
+        err('--split-index requires --split-pages, --split-size or --split-labels')
+    if prog_args.linearize and QPDF_BIN is None:
+        err('--linearize requires qpdf, install it from https://qpdf.sourceforge.io')
+
+    # Layered pages are composed by the writer from the page image and
+    # separate label and number overlays.
+    layered = prog_args.dedupe or prog_args.encoding != 'rgb'
+
+    # Let each convert use its share of the memory budget before falling back
+    # to memory mapped and then disk pixel cache.
+    magick_limit_args = []
+    if max_memory is not None:
+        magick_mem = max(max_memory // max(prog_args.concurrency, 1), page_job_mem())
+        magick_limit_args += [ '-limit', 'memory', f'{magick_mem >> 20}MiB',
+                               '-limit', 'map', f'{(magick_mem * 2) >> 20}MiB' ]
+        nr_fit = max(max_memory // page_job_mem(), 1)
+        if nr_fit < prog_args.concurrency:
+            info(f'Memory budget {format_size(max_memory)} fits {nr_fit} concurrent '
+                 f'page jobs at {prog_args.dpi} dpi')
+    if prog_args.max_scratch is not None and max_scratch > 0:
+        magick_limit_args += [ '-limit', 'disk', f'{max_scratch >> 20}MiB' ]
+
+    # prepare resized header and footer
+    header_file = None
+    footer_file = None
+    if prog_args.header is not None:
+        header_file = resized_header(prog_args.header, header_height)
+    if prog_args.footer is not None:
+        footer_file = resized_header(prog_args.footer, footer_height)
+
+    # determine the output path
+    # --worker tasks don't write an output
+    output_path = prog_args.output
+    if (output_path is not None and prog_args.numbered_output and
+        output_exists(output_path)):
+        (base, ext) = os.path.splitext(output_path)
+        nr = 1
+        while True:
+            output_path = f'{base}.{nr}{ext}'
+            if not output_exists(output_path):
+                break
+            nr += 1
+
+    label_atlas = glyph_atlas('label', prog_args.label_font, label_height,
+                              prog_args.label_color)
+    number_atlas = glyph_atlas('number', prog_args.number_font, number_height,
+                               prog_args.number_color)
+
+# Options which --serve and --manifest jobs take from the command line
+# instead of their own arguments
+GLOBAL_ARGS = [ 'concurrency', 'max_memory', 'max_scratch', 'cache_dir',
+                'cache_size', 'clear_cache', 'watch', 'watch_interval', 'serve',
+                'manifest', 'promote', 'worker', 'workers', 'tempdir', 'resume',
+                'scratch_dir', 'trace', 'verbose' ]
+
+def build_with_args(argv):
+    '''
+    Build with prog_args replaced by argv combined with GLOBAL_ARGS from the
+    command line and return the output path. Raises SystemExit or Exception
+    on failure.
+    '''
+    global prog_args
+    global_args = prog_args
+    try:
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            raise Exception('invalid arguments')
+        for name in GLOBAL_ARGS:
+            setattr(args, name, getattr(global_args, name))
+        if len(args.src) == 0 or args.output is None:
+            raise Exception('at least one source and --output are required')
+        prog_args = args
+        configure()
+        build(find_pdfs())
+        return output_path
+    finally:
+        prog_args = global_args
+
+class Job:
+    def __init__(self, nr, argv):
+        self.nr = nr
+        self.argv = argv
+        self.state = 'queued'
+        self.output = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def status(self):
+        st = { 'job': self.nr, 'state': self.state, 'args': self.argv,
+               'output': self.output, 'error': self.error }
+        if self.started_at is not None:
+            st['queue_wait'] = self.started_at - self.submitted_at
+        if self.finished_at is not None:
+            st['run_time'] = self.finished_at - self.started_at
+            st['latency'] = self.finished_at - self.submitted_at
+        return st
+
+class JobServer:
+    '''
+    Queue of --serve jobs. Jobs are built one at a time by a dedicated
+    thread with prog_args replaced by the job's arguments. The job state is
+    kept for the last MAX_JOBS jobs.
+    '''
+    MAX_JOBS = 1000
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.jobs = collections.OrderedDict()
+        self.nr_jobs = 0
+        self.running = None
+        self.nr_done = 0
+        self.nr_failed = 0
+        self.latencies = collections.deque(maxlen=self.MAX_JOBS)
+        threading.Thread(target=self.run_fn, daemon=True).start()
+
+    def submit(self, argv):
+        with self.cond:
+            self.nr_jobs += 1
+            job = Job(self.nr_jobs, argv)
+            self.jobs[job.nr] = job
+            while len(self.jobs) > self.MAX_JOBS:
+                self.jobs.popitem(last=False)
+            self.queue.append(job)
+            self.cond.notify_all()
+        info(f'Job {job.nr} queued, {len(self.queue)} in queue')
+        return job
+
+    def get(self, nr):
+        with self.cond:
+            return self.jobs.get(nr)
+
+    def status(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            st = { 'queue_depth': len(self.queue),
+                   'running': self.running.nr if self.running is not None else None,
+                   'done': self.nr_done,
+                   'failed': self.nr_failed }
+        if len(latencies) > 0:
+            st['latency'] = { 'last': self.latencies[-1],
+                              'mean': sum(latencies) / len(latencies),
+                              'p50': latencies[len(latencies) // 2],
+                              'p95': latencies[len(latencies) * 95 // 100],
+                              'max': latencies[-1] }
+        return st
+
+    def run_fn(self):
+        while True:
+            with self.cond:
+                while len(self.queue) == 0:
+                    self.cond.wait()
+                job = self.queue.popleft()
+                self.running = job
+                job.state = 'running'
+                job.started_at = time.time()
+            self.run_job(job)
+            with self.cond:
+                self.running = None
+                job.finished_at = time.time()
+                self.latencies.append(job.finished_at - job.submitted_at)
+                if job.state == 'done':
+                    self.nr_done += 1
+                else:
+                    self.nr_failed += 1
+            info(f'Job {job.nr} {job.state} in '
+                 f'{job.finished_at - job.submitted_at:.2f}s')
+            job.done.set()
+
+    def run_job(self, job):
+        global last_error
+        last_error = None
+        try:
+            job.output = build_with_args(job.argv)
+            job.state = 'done'
+        except SystemExit:
+            job.state = 'failed'
+            job.error = last_error if last_error is not None else 'failed'
+        except Exception as e:
+            job.state = 'failed'
+            job.error = f'{e}'
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', f'{len(body)}')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        m = re.match(r'^/jobs/([0-9]+)$', self.path)
+        if self.path == '/status':
+            self.send_json(200, job_server.status())
+        elif m is not None and job_server.get(int(m.group(1))) is not None:
+            self.send_json(200, job_server.get(int(m.group(1))).status())
+        else:
+            self.send_json(404, { 'error': 'not found' })
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self.send_json(404, { 'error': 'not found' })
+            return
+        try:
+            spec = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            argv = spec['args']
+            if not isinstance(argv, list) or not all(isinstance(a, str) for a in argv):
+                raise Exception('"args" must be a list of strings')
+        except Exception as e:
+            self.send_json(400, { 'error': f'invalid job spec ({e})' })
+            return
+        job = job_server.submit(argv)
+        if spec.get('wait', False):
+            job.done.wait()
+            self.send_json(200, job.status())
+        else:
+            self.send_json(202, job.status())
+
+    def log_message(self, format, *args):
+        dbg(f'serve: {format % args}')
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # set when used, socket.AF_UNIX doesn't exist on some platforms, e.g. windows
+    address_family = None
+    daemon_threads = True
+
+    def server_bind(self):
+        # HTTPServer.server_bind() expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def listen(addr, handler):
+    # HTTP server on ADDR, [HOST:]PORT or unix:PATH
+    try:
+        if addr.startswith('unix:'):
+            if not hasattr(socket, 'AF_UNIX'):
+                raise ValueError('unix sockets aren\'t supported on this platform')
+            path = addr[len('unix:'):]
+            # remove a stale socket left behind by a previous server
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            UnixHTTPServer.address_family = socket.AF_UNIX
+            return UnixHTTPServer(path, handler)
+        (host, sep, port) = addr.rpartition(':')
+        return http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+    except (OSError, ValueError) as e:
+        err(f'Failed to listen on "{addr}" ({e})')
+
+def serve(addr):
+    global job_server
+    job_server = JobServer()
+    server = listen(addr, JobRequestHandler)
+
+    info(f'Serving jobs on {addr}, press Ctrl-C to exit...')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+# options in manifests which are paths relative to the manifest
+MANIFEST_PATH_KEYS = [ 'output', 'header', 'footer' ]
+
+def manifest_argv(entry, base_dir):
+    # Convert a manifest entry into command line arguments. Keys are long
+    # option names, True and False toggle flags, "sources" is the list of
+    # source files and directories.
+    argv = []
+    for (key, value) in entry.items():
+        if key == 'sources':
+            continue
+        opt = '--' + key.replace('_', '-')
+        action = parser._option_string_actions.get(opt)
+        if action is None or action.dest in GLOBAL_ARGS:
+            raise Exception(f'unknown or global option "{key}"')
+        if action.nargs == 0:
+            if value:
+                argv.append(opt)
+            continue
+        if isinstance(value, bool):
+            value = 'true' if value else ''
+        elif key in MANIFEST_PATH_KEYS:
+            value = os.path.join(base_dir, value)
+        argv += [ opt, f'{value}' ]
+
+    sources = entry.get('sources', [])
+    if isinstance(sources, str):
+        sources = [ sources ]
+    return argv + [ '--' ] + [ os.path.join(base_dir, src) for src in sources ]
+
+def run_manifest(path):
+    '''
+    Build all outputs described in the manifest at path, a JSON or YAML
+    object with "outputs", a list of option objects, and optional
+    "defaults" which are applied to each output. The outputs are built one
+    by one sharing the page cache, page counts, resized headers and footers
+    and glyph atlases, so pages used by multiple outputs are rendered once
+    per geometry.
+    '''
+    global last_error
+    try:
+        with open(path) as f:
+            if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+                try:
+                    import yaml
+                except ImportError:
+                    err('YAML manifests require PyYAML, install it with '
+                        '"pip install pyyaml"')
+                manifest = yaml.safe_load(f)
+            else:
+                manifest = json.load(f)
+        defaults = manifest.get('defaults', {})
+        outputs = manifest['outputs']
+        base_dir = os.path.dirname(path)
+        argvs = [ manifest_argv(dict(defaults, **entry), base_dir) for entry in outputs ]
+    except Exception as e:
+        err(f'Failed to load manifest "{path}" ({e})')
+
+    failed = []
+    for (i, argv) in enumerate(argvs):
+        info(f'Building output {i + 1}/{len(argvs)}...')
+        last_error = None
+        try:
+            build_with_args(argv)
+        except SystemExit:
+            failed.append((i, last_error if last_error is not None else 'failed'))
+        except Exception as e:
+            failed.append((i, f'{e}'))
+
+    for (i, reason) in failed:
+        warn(f'Output {i + 1} failed ({reason})')
+    if len(failed) > 0:
+        err(f'{len(failed)} of {len(argvs)} outputs failed')
+    info(f'{len(argvs)} outputs built')
+
+def job_options_argv(skip=()):
+    # Convert the options of the current job except for the global ones, the
+    # sources and the ones in skip back into command line arguments, for
+    # --proof and --workers.
+    argv = []
+    for action in parser._actions:
+        if (len(action.option_strings) == 0 or action.dest in GLOBAL_ARGS or
+            action.dest in ('help', 'keep_order', 'proof', 'proof_dpi') or
+            action.dest in skip):
+            continue
+        value = getattr(prog_args, action.dest)
+        if value == action.default:
+            continue
+        opt = max(action.option_strings, key=len)
+        if action.nargs == 0:
+            argv.append(opt)
+            continue
+        if isinstance(value, bool):
+            value = 'true' if value else ''
+        elif action.dest in MANIFEST_PATH_KEYS:
+            value = os.path.abspath(value)
+        argv += [ opt, f'{value}' ]
+    return argv
+
+def write_promote_job(docs):
+    '''
+    Record the arguments which build the current proof at full resolution
+    into OUTPUT.job. The sources are listed in the order of the proof with
+    their selected pages, so the promoted build has the same pages, labels
+    and numbers even if the directories or sidecar files change meanwhile.
+    '''
+    argv = promote_args + [ '--keep-order', '--' ]
+    for (pdf, doc_pages) in docs:
+        if len(doc_pages) == 0:
+            continue
+        nrs = [ page.nr for page in doc_pages ]
+        argv.append(f'{os.path.abspath(pdf)}[{page_list(nrs)}]')
+    path = f'{output_path}.job'
+    with open(path, 'w') as f:
+        json.dump({ 'argv': argv }, f, indent=2)
+    info(f'Proof at {prog_args.dpi} dpi, build it at full resolution with '
+         f'"--promote {path}"')
+
+def run_promote(path):
+    try:
+        with open(path) as f:
+            argv = json.load(f)['argv']
+    except Exception as e:
+        err(f'Failed to load job "{path}" ({e})')
+    try:
+        output = build_with_args(argv)
+    except Exception as e:
+        err(f'Promoting "{path}" failed ({e})')
+    info(f'Promoted "{path}" to "{output}"')
+
+# Distributed rendering. A --worker renders and processes tasks of pages for
+# the --workers coordinators which send them and write the output. Sources,
+# headers, footers and fonts are uploaded by their sha256, so each file is
+# transferred to a worker only once.
+
+# options whose values are uploaded to the workers if they're files
+REMOTE_FILE_OPTS = [ '--header', '--footer', '--label-font', '--number-font' ]
+# options which only affect writing the output on the coordinator
+REMOTE_SKIP_ARGS = [ 'output', 'numbered_output', 'split_pages', 'split_size',
+                     'split_labels', 'split_index', 'linearize' ]
+# options which tasks can set in their argv besides font names, anything
+# else could make the worker read or write its own files
+REMOTE_TASK_ARGS = [ 'dpi', 'size', 'header_height', 'footer_height', 'label_sep',
+                     'label_height', 'label_gravity', 'label_margin', 'label_color',
+                     'number_start', 'number_height', 'number_gravity', 'number_margin',
+                     'number_color', 'fused', 'backend', 'batch', 'batch_size', 'assemble',
+                     'intermediate', 'dedupe', 'encoding', 'jpeg_quality' ]
+
+class RemoteTaskError(Exception):
+    pass
+
+class MissingFilesError(Exception):
+    pass
+
+def valid_digest(digest):
+    return isinstance(digest, str) and re.fullmatch(r'[0-9a-f]{64}', digest) is not None
+
+def worker_file(digest):
+    # digest comes from the coordinator, check it before it becomes a path
+    if not valid_digest(digest):
+        raise Exception(f'invalid file digest {digest!r}')
+    return f'{tempdir}/files/{digest}'
+
+def check_task_args(args, files):
+    # Only REMOTE_TASK_ARGS and font names can be set in a task's argv,
+    # files can only be given by the digests of uploaded ones.
+    if len(args.src) > 0:
+        raise Exception('sources can\'t be given in argv')
+    for action in parser._actions:
+        if len(action.option_strings) == 0 or action.dest == 'help':
+            continue
+        opt = max(action.option_strings, key=len)
+        value = getattr(args, action.dest)
+        if opt in files or value == action.default or action.dest in REMOTE_TASK_ARGS:
+            continue
+        if action.dest in ('label_font', 'number_font'):
+            if re.search(r'[/\\:@]', value) is None and not os.path.exists(value):
+                continue
+            raise Exception(f'{opt} must be a font name or an uploaded file')
+        raise Exception(f'{opt} can\'t be set by a task')
+
+def check_page_spec(spec):
+    # stem ends up in scratch file names
+    stem = spec['stem']
+    if not isinstance(stem, str) or stem in ('', '.', '..') or re.search(r'[/\\\0]', stem):
+        raise Exception(f'invalid stem {stem!r}')
+    if not isinstance(spec['nr'], int):
+        raise Exception(f'invalid page number {spec["nr"]!r}')
+    fit = spec['fit']
+    if fit is not None and (not isinstance(fit, list) or len(fit) != 2 or
+                            not all(isinstance(x, int) for x in fit)):
+        raise Exception(f'invalid fit {fit!r}')
+    if spec['label'] is not None and not isinstance(spec['label'], str):
+        raise Exception(f'invalid label {spec["label"]!r}')
+    if spec['number'] is not None and not isinstance(spec['number'], int):
+        raise Exception(f'invalid number {spec["number"]!r}')
+
+def use_worker_files(digests):
+    # Mark the files of a task as recently used and evict the least
+    # recently used other files over --cache-size.
+    missing = [ digest for digest in digests if not os.path.exists(worker_file(digest)) ]
+    if len(missing) > 0:
+        raise MissingFilesError(missing)
+    for digest in digests:
+        os.utime(worker_file(digest))
+
+    files = []
+    for name in os.listdir(f'{tempdir}/files'):
+        # uploads in progress have a suffix
+        if valid_digest(name) and name not in digests:
+            try:
+                st = os.stat(worker_file(name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, worker_file(name)))
+    files.sort()
+    total = sum(f[1] for f in files) + sum(os.path.getsize(worker_file(d)) for d in digests)
+    for (mtime, fsize, path) in files:
+        if total <= cache_size:
+            break
+        dbg(f'Evicting uploaded file "{path}"')
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= fsize
+
+worker_lock = threading.Lock()
+
+def run_task(task):
+    '''
+    Render and process the pages of a task from a --workers coordinator and
+    return their processed files in order. prog_args is replaced by the
+    task's options combined with GLOBAL_ARGS from the command line. Raises
+    SystemExit or Exception on failure.
+    '''
+    global prog_args
+    worker_args = prog_args
+    try:
+        argv = list(task['argv'])
+        if not all(isinstance(arg, str) for arg in argv):
+            raise Exception('invalid arguments')
+        for (opt, digest) in task['files'].items():
+            if opt not in REMOTE_FILE_OPTS:
+                raise Exception(f'invalid file option {opt!r}')
+            argv += [ opt, worker_file(digest) ]
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            raise Exception('invalid arguments')
+        check_task_args(args, task['files'])
+        for spec in task['pages']:
+            check_page_spec(spec)
+        use_worker_files(set(task['files'].values()) | { task['pdf'] })
+        for name in GLOBAL_ARGS:
+            setattr(args, name, getattr(worker_args, name))
+        prog_args = args
+        configure()
+
+        # scratch_dir has to be settled before the pages name their files
+        setup_scratch_dir(len(task['pages']))
+        pdf = worker_file(task['pdf'])
+        pages = []
+        for (i, spec) in enumerate(task['pages']):
+            page = Page(i, pdf, spec['stem'], spec['nr'])
+            page.fit = tuple(spec['fit']) if spec['fit'] is not None else None
+            page.label = spec['label']
+            page.number = spec['number']
+            pages.append(page)
+
+        label_atlas.render(''.join(page.label for page in pages if page.label is not None))
+        if any(page.number is not None for page in pages):
+            number_atlas.render('0123456789-')
+
+        def page_done(page):
+            pool.submit(f'processing "{page.stem}"', process_pages, [ page ],
+                        prio=PRIO_PAGE, mem=page_job_mem())
+
+        def render_fn(chunk):
+            info(f'Rendering "{chunk[0].stem}" and {len(chunk) - 1} more pages...')
+            render_pages(pdf, chunk, page_done)
+
+        for chunk in split_render_chunks(pages):
+            pool.submit(f'rendering "{chunk[0].stem}"', render_fn, chunk,
+                        cost=len(chunk), prio=PRIO_RENDER, mem=render_job_mem(),
+                        scratch=len(chunk) * page_scratch_bytes())
+        failures = pool.wait()
+        if len(failures) > 0:
+            (desc, e) = failures[0]
+            raise Exception(f'{len(failures)} jobs failed, first {desc} ({e})')
+        return [ page.file for page in pages ]
+    finally:
+        prog_args = worker_args
+
+class WorkerRequestHandler(JobRequestHandler):
+    '''
+    Requests from --workers coordinators.
+
+      GET /files/SHA256   200 if the file has been uploaded, 404 otherwise.
+      PUT /files/SHA256   Upload a file, rejected unless the content matches.
+      POST /tasks         Run a task, {"argv": [ARG...], "files": {OPT: SHA256},
+                          "pdf": SHA256, "pages": [PAGE...]}, where each PAGE
+                          is {"stem", "nr", "fit", "label", "number"}. The
+                          response is a JSON line {"sizes": [SIZE...]}
+                          followed by the processed page files, or 409 if
+                          some of the files have been evicted since they
+                          were uploaded.
+
+    Uploaded files are evicted least recently used over --cache-size.
+    '''
+    def file_digest(self):
+        m = re.match(r'^/files/(.*)$', self.path)
+        return m.group(1) if m is not None and valid_digest(m.group(1)) else None
+
+    def do_GET(self):
+        digest = self.file_digest()
+        if digest is not None and os.path.exists(worker_file(digest)):
+            self.send_json(200, {})
+        else:
+            self.send_json(404, { 'error': 'not found' })
+
+    def do_PUT(self):
+        digest = self.file_digest()
+        if digest is None:
+            self.send_json(404, { 'error': 'not found' })
+            return
+        path = worker_file(digest)
+        # concurrent uploads of the same file write to their own temp files
+        tmp = f'{path}.{threading.get_ident()}'
+        left = int(self.headers.get('Content-Length', 0))
+        with open(tmp, 'wb') as f:
+            while left > 0:
+                data = self.rfile.read(min(left, 1 << 20))
+                if len(data) == 0:
+                    break
+                f.write(data)
+                left -= len(data)
+        if file_hash(tmp) != digest:
+            os.unlink(tmp)
+            self.send_json(400, { 'error': 'content doesn\'t match the hash' })
+            return
+        os.replace(tmp, path)
+        self.send_json(200, {})
+
+    def do_POST(self):
+        global last_error
+        if self.path != '/tasks':
+            self.send_json(404, { 'error': 'not found' })
+            return
+        try:
+            task = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except Exception as e:
+            self.send_json(400, { 'error': f'invalid task ({e})' })
+            return
+
+        # tasks run one at a time using all workers of the pool
+        with worker_lock:
+            last_error = None
+            try:
+                files = run_task(task)
+            except MissingFilesError as e:
+                self.send_json(409, { 'error': 'files missing', 'missing': e.args[0] })
+                return
+            except SystemExit:
+                self.send_json(500, { 'error': last_error if last_error is not None else 'failed' })
+                return
+            except Exception as e:
+                self.send_json(500, { 'error': f'{e}' })
+                return
+            try:
+                header = json.dumps({ 'sizes': [ os.path.getsize(path) for path in files ] })
+                header = header.encode() + b'\n'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length',
+                                 f'{len(header) + sum(os.path.getsize(path) for path in files)}')
+                self.end_headers()
+                self.wfile.write(header)
+                for path in files:
+                    with open(path, 'rb') as f:
+                        shutil.copyfileobj(f, self.wfile)
+            finally:
+                for path in files:
+                    release_file(path)
+
+    def log_message(self, format, *args):
+        dbg(f'worker: {format % args}')
+
+def run_worker(addr):
+    os.makedirs(f'{tempdir}/files', exist_ok=True)
+    server = listen(addr, WorkerRequestHandler)
+
+    info(f'Working for coordinators on {addr}, press Ctrl-C to exit...')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+class RemoteWorkers:
+    '''
+    The --workers of a coordinator. Each worker is sent up to REMOTE_SLOTS
+    tasks at a time. A worker which can't be reached is dropped for the
+    rest of the run and its tasks are retried on the other workers.
+    '''
+    def __init__(self, addrs):
+        self.cond = threading.Condition()
+        self.busy = { addr: 0 for addr in addrs }
+        # digests of the files each worker is known to have
+        self.uploaded = { addr: set() for addr in addrs }
+
+    def acquire(self, exclude):
+        # Return the least busy worker not in exclude once it has a free
+        # slot, None if there's no such worker left.
+        with self.cond:
+            while True:
+                addrs = [ addr for addr in self.busy if addr not in exclude ]
+                if len(addrs) == 0:
+                    return None
+                addr = min(addrs, key=lambda addr: self.busy[addr])
+                if self.busy[addr] < REMOTE_SLOTS:
+                    self.busy[addr] += 1
+                    return addr
+                self.cond.wait()
+
+    def release(self, addr):
+        with self.cond:
+            if addr in self.busy:
+                self.busy[addr] -= 1
+            self.cond.notify_all()
+
+    def drop(self, addr, e):
+        with self.cond:
+            if addr in self.busy:
+                del self.busy[addr]
+                warn(f'Lost worker {addr} ({e}), {len(self.busy)} left')
+            self.cond.notify_all()
+
+    def connect(self, addr):
+        (host, sep, port) = addr.rpartition(':')
+        return http.client.HTTPConnection(host or '127.0.0.1', int(port),
+                                          timeout=REMOTE_TIMEOUT)
+
+    def upload(self, addr, digest, path):
+        if digest in self.uploaded[addr]:
+            return
+        conn = self.connect(addr)
+        try:
+            conn.request('GET', f'/files/{digest}')
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                dbg(f'Uploading "{path}" to {addr}')
+                with open(path, 'rb') as f:
+                    conn.request('PUT', f'/files/{digest}', body=f,
+                                 headers={ 'Content-Length': f'{os.path.getsize(path)}' })
+                    resp = conn.getresponse()
+                    resp.read()
+                if resp.status != 200:
+                    raise RemoteTaskError(f'failed to upload "{path}" (HTTP {resp.status})')
+        finally:
+            conn.close()
+        self.uploaded[addr].add(digest)
+
+    def run(self, addr, task, pages, files):
+        '''
+        Upload the files, {digest: path}, which addr doesn't have yet, run
+        task on it and point pages at the returned processed files.
+        '''
+        for (digest, path) in files.items():
+            self.upload(addr, digest, path)
+        written = []
+        conn = self.connect(addr)
+        try:
+            conn.request('POST', '/tasks', body=json.dumps(task).encode(),
+                         headers={ 'Content-Type': 'application/json' })
+            resp = conn.getresponse()
+            if resp.status == 409:
+                # the worker has evicted some of the files, upload them again
+                resp.read()
+                self.uploaded[addr].difference_update(files)
+                for (digest, path) in files.items():
+                    self.upload(addr, digest, path)
+                conn.request('POST', '/tasks', body=json.dumps(task).encode(),
+                             headers={ 'Content-Type': 'application/json' })
+                resp = conn.getresponse()
+            if resp.status != 200:
+                try:
+                    error = json.loads(resp.read())['error']
+                except (ValueError, KeyError):
+                    error = f'HTTP {resp.status}'
+                raise RemoteTaskError(error)
+            sizes = json.loads(resp.readline())['sizes']
+            if len(sizes) != len(pages):
+                raise RemoteTaskError(f'{len(sizes)} pages returned for {len(pages)}')
+            for (page, left) in zip(pages, sizes):
+                dst = scratch_file('REMOTE', page.stem)
+                with open(dst, 'wb') as f:
+                    written.append(dst)
+                    while left > 0:
+                        data = resp.read(min(left, 1 << 20))
+                        if len(data) == 0:
+                            raise http.client.IncompleteRead(b'', left)
+                        f.write(data)
+                        left -= len(data)
+                trace_file(dst)
+        except BaseException:
+            for dst in written:
+                release_file(dst)
+            raise
+        finally:
+            conn.close()
+        for (page, dst) in zip(pages, written):
+            page.file = dst
 
 # main starts here
 MM_PER_IN = 25.4
+RENDER_CHUNK_MIN = 8
 
 GRAVITY_X = { 'northwest' : 'west',
               'north'     : 'center',
@@ -342,6 +3456,41 @@ if is_windows():
 
 prog_args = parser.parse_args()
 
+tracer = None
+if prog_args.trace is not None:
+    tracer = Tracer()
+    # write out what's been recorded if the build fails
+    atexit.register(lambda: len(tracer.events) > 0 and tracer.write(prog_args.trace))
+
+if prog_args.clear_cache:
+    if prog_args.cache_dir is None:
+        parser.error('--clear-cache requires --cache-dir')
+    clear_cache()
+    if (len(prog_args.src) == 0 and prog_args.serve is None and
+        prog_args.manifest is None and prog_args.promote is None and
+        prog_args.worker is None):
+        sys.exit(0)
+
+if prog_args.worker is not None:
+    if (prog_args.serve is not None or prog_args.manifest is not None or
+        prog_args.promote is not None or prog_args.workers is not None or prog_args.watch):
+        parser.error('--worker can\'t be used with --serve, --manifest, --promote, '
+                     '--workers or --watch')
+elif prog_args.promote is not None:
+    if prog_args.serve is not None or prog_args.manifest is not None or prog_args.watch:
+        parser.error('--promote can\'t be used with --serve, --manifest or --watch')
+elif prog_args.serve is None and prog_args.manifest is None:
+    if len(prog_args.src) == 0:
+        parser.error('at least one source is required')
+    if prog_args.output is None:
+        parser.error('--output is required')
+elif prog_args.serve is not None and prog_args.manifest is not None:
+    parser.error('--serve and --manifest can\'t be used together')
+elif prog_args.watch:
+    parser.error('--watch can\'t be used with --serve or --manifest')
+if prog_args.resume and prog_args.tempdir is None:
+    parser.error('--resume requires --tempdir')
+
 GS_BIN = find_bin('gs', 'C:/Program Files/gs/gs*/bin/gswin*c.EXE')
 if GS_BIN is None:
     err(f'Ghostscript is not found. Please install from https://www.ghostscript.com/')
@@ -349,96 +3498,36 @@ if GS_BIN is None:
 MAGICK_BIN = find_magick_bin('magick', 'C:/Program Files/ImageMagick*/magick.EXE')
 if MAGICK_BIN is None:
     CONVERT_BIN = find_magick_bin('convert')
-    COMPOSITE_BIN = find_magick_bin('composite')
-    if CONVERT_BIN is None or COMPOSITE_BIN is None:
+    if CONVERT_BIN is None:
         err(f'ImageMagick is not found. Please install from https://imagemagick.org')
 else:
     CONVERT_BIN = None
-    COMPOSITE_BIN = None
+
+# only needed for --linearize, see configure()
+QPDF_BIN = find_bin('qpdf', 'C:/Program Files/qpdf*/bin/qpdf.exe')
 
 if not 'ilovetj' in sys.argv[0]:
     err(f'Command name {sys.argv[0]} does not contain "ilovetj"')
 
-# parse paper size
-try:
-    paper_size = prog_args.size.split('x', 2)
-    paper_size = (float(paper_size[0]), float(paper_size[1]))
-    if paper_size[0] <= 0 or paper_size[1] <= 0:
-        raise Exception('must be positive')
-except Exception as e:
-    err(f'--size must be in the format WIDTHxHEIGHT ({e})')
-
-# convert that to pixel size based on the dpi
-size = (int(paper_size[0] / MM_PER_IN * prog_args.dpi),
-        int(paper_size[1] / MM_PER_IN * prog_args.dpi))
-
-# parse label margin
+# parse cache size
 try:
-    label_margin = prog_args.label_margin.split('x', 2)
-    label_margin = (int(size[0] * float(label_margin[0]) / 100),
-                    int(size[1] * float(label_margin[1]) / 100))
+    cache_size = parse_size(prog_args.cache_size)
 except Exception as e:
-    err(f'--label-margin must be in the format XPCTxYPCT ({e})')
-
-# parse number start
-if prog_args.number_start is None:
-    number_start = None
-else:
-    try:
-        number_start = int(prog_args.number_start)
-    except Exception as e:
-        err(f'--number-start must be an integer ({e})')
+    err(f'--cache-size must be a number optionally followed by K, M, G or T ({e})')
 
-# parse number margin
+# parse memory and scratch limits
 try:
-    number_margin = prog_args.number_margin.split('x', 2)
-    number_margin = (int(size[0] * float(number_margin[0]) / 100),
-                     int(size[1] * float(number_margin[1]) / 100))
+    if prog_args.max_memory is not None:
+        max_memory = parse_size(prog_args.max_memory) or None
+    else:
+        max_memory = available_memory()
+        if max_memory is not None:
+            max_memory = int(max_memory * 0.8)
+    if prog_args.max_scratch is not None:
+        max_scratch = parse_size(prog_args.max_scratch)
 except Exception as e:
-    err(f'--label-margin must be in the format XPCTxYPCT ({e})')
-
-# determine header, content and footer sizes
-header_height = 0
-footer_height = 0
-
-if prog_args.header is not None:
-    header_height = int(size[1] * prog_args.header_height / 100.0)
-
-if prog_args.footer is not None:
-    footer_height = int(size[1] * prog_args.footer_height / 100.0)
-
-body_height = size[1] - header_height - footer_height
-
-info(f'paper={paper_size[0]}x{paper_size[1]} pixels={size[0]}x{size[1]} '
-     f'header:body:footer={header_height}:{body_height}:{footer_height}')
-
-if header_height < 0 or body_height < 0 or footer_height < 0:
-    err('Some heights came out negative')
-
-# determine source files
-pdfs = []
-for src in prog_args.src:
-    if os.path.isdir(src):
-        pdfs += sorted_mixed_basename(glob.glob(f'{src}/*.pdf'))
-        continue
-    elif os.path.isfile(src):
-        pdfs.append(src)
-        continue
-    elif is_windows() and len(src) and src[-1] == '"':
-        # When run through windows powershell, quoting somehow can get
-        # broken and source may end up with a trailing extra double quote.
-        src = src[:-1]
-        if os.path.isdir(src):
-            pdfs += sorted_mixed_basename(glob.glob(f'{src}/*.pdf'))
-            continue
-        elif os.path.isfile(src):
-            pdfs.append(src)
-            continue
-
-    err(f'Invalid source file/dir "{src}"')
-
-if not prog_args.keep_order:
-    pdfs = sorted_mixed_basename(pdfs)
+    err(f'--max-memory and --max-scratch must be a number optionally followed by '
+        f'K, M, G or T ({e})')
 
 # create tempdir
 if prog_args.tempdir is None:
@@ -448,182 +3537,564 @@ else:
     tempdir = prog_args.tempdir.rstrip('/')
     os.makedirs(tempdir, exist_ok=True)
 
-dbg(f'pdfs={pdfs} tempdir={tempdir}')
+dbg(f'tempdir={tempdir}')
 
-# prepare resized header and footer
-header_file = None
-footer_file = None
+# intermediate files are kept in an explicit tempdir, journal them for --resume
+journal = None
+if prog_args.tempdir is not None:
+    journal = Journal(f'{tempdir}/journal', prog_args.resume)
 
-if prog_args.header is not None:
-    header_file = f'{tempdir}/__HEADER__.png'
-    resize_header(prog_args.header, header_file, (size[0], header_height))
-if prog_args.footer is not None:
-    footer_file = f'{tempdir}/__FOOTER__.png'
-    resize_header(prog_args.footer, footer_file, (size[0], footer_height))
+# intermediate page files go into scratch_dir, see setup_scratch_dir()
+scratch_dir = tempdir
+shm_tempdir_obj = None
+if prog_args.scratch_dir is not None:
+    scratch_dir = prog_args.scratch_dir.rstrip('/')
+    os.makedirs(scratch_dir, exist_ok=True)
 
-# convert to pngs
-srcs = []
-args_set = []
-for pdf in pdfs:
-    stem = stem_name(pdf)
-    args = [stem]
-    args += [ '-q', '-dQUIET', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dNOPROMPT',
-              '-dMaxBitMap=500000000', '-dAlignToPixels=0', '-dGridFitTT=2',
-              '-sDEVICE=png16m', '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4',
-              f'-r{prog_args.dpi}',
-              f'-sOutputFile={tempdir}/SRC_{stem}-%d.png', pdf ]
-    args_set.append(args)
-    srcs.append(f'SRC_{stem}.png')
-
-def render_fn(args):
-    info(f'Rendering "{args[0]}"...')
-    run_gs(args[1:])
-
-run_parallel(args_set, render_fn, prog_args.concurrency)
-
-new_srcs = []
-for src in srcs:
-    pattern = f'{tempdir}/{os.path.splitext(src)[0]}*.png'
-    new_srcs += [ os.path.basename(p) for p in sorted_mixed_basename(glob.glob(pattern)) ]
-dbg(f'srcs={srcs} new_srcs={new_srcs}')
-srcs = new_srcs
-
-# resize to body_height
-resized = []
-args_set = []
-for src in srcs:
-    dst = f'RESIZED_{src.split("_", 1)[1]}'
-
-    args = [stem_name(dst).split('_', 1)[1]]
-    args += [f'{tempdir}/{src}',
-             '(', '-strip', ')',
-             '(', '-resize', f'{size[0]}x{body_height}', ')',
-             '(', '-gravity', 'center', '-extent', f'{size[0]}x{body_height}', ')',
-             f'{tempdir}/{dst}']
-
-    args_set.append(args)
-    resized.append(dst)
-
-def resize_fn(args):
-    info(f'Resizing "{args[0]}"...')
-    run_convert(args[1:])
-
-run_parallel(args_set, resize_fn, prog_args.concurrency)
-srcs = resized
-
-# merge header and footer
-if header_file is not None or footer_file is not None:
-    merged = []
-    args_set = []
-    for src in srcs:
-        dst = f'MERGED_{src.split("_", 1)[1]}'
-        src_file = f'{tempdir}/{src}'
-        dst_file = f'{tempdir}/{dst}'
-
-        args = [stem_name(dst).split('_', 1)[1]]
-        args += [ '-append' ]
-        if header_file is not None:
-            args.append(header_file)
-        args.append(src_file)
-        if footer_file is not None:
-            args.append(footer_file)
-        args.append('-strip')
-        args.append(dst_file)
-
-        args_set.append(args)
-        merged.append(dst)
-
-    def merge_fn(args):
-        info(f'Merging "{args[0]}"...')
-        run_convert(args[1:])
-
-    run_parallel(args_set, merge_fn, prog_args.concurrency)
-    srcs = merged
-
-# label
-if prog_args.label_sep is not None:
-    # generate labels
-    label_height = int(size[1] * prog_args.label_height / 100)
-    labels = set()
-    label_files = {}
-    args_set = []
-    for src in srcs:
-        stem = os.path.splitext(src.split('_', 1)[1])[0]
-        label = stem.split(prog_args.label_sep, 1)[0]
-        label_file = f'{tempdir}/LABEL_{label}.png'
-        label_files[src] = label_file
-
-        if label in labels:
+if ((prog_args.watch or prog_args.serve is not None or prog_args.manifest is not None)
+    and prog_args.cache_dir is None):
+    prog_args.cache_dir = f'{tempdir}/cache'
+
+pool = WorkerPool(prog_args.concurrency, max_memory)
+pool.scratch_fn = scratch_usage
+PRIO_PAGE = 0
+PRIO_RENDER = 1
+PRIO_REMOTE = 2
+# A render job holds its worker until its whole chunk is rendered. Keep the
+# rest of the workers for processing the rendered pages so that they don't
+# pile up in scratch. With a single worker, rendering and processing take
+# turns per chunk.
+render_slots = max((prog_args.concurrency + 1) // 2, 1)
+pool.prio_limits[PRIO_RENDER] = render_slots
+# largest automatic --batch-size, each page is dropped once written so this
+# only bounds the latency and granularity of a batch
+BATCH_MAX_SIZE = 16
+# pages per --workers task, tasks in flight per worker and the timeout of
+# each network operation. A worker runs one task at a time, a second task in
+# flight would wait for it within REMOTE_TIMEOUT.
+REMOTE_TASK_PAGES = 16
+REMOTE_SLOTS = 1
+REMOTE_TIMEOUT = 600
+
+remote = None
+if prog_args.workers is not None:
+    remote = RemoteWorkers([ addr.strip() for addr in prog_args.workers.split(',')
+                             if addr.strip() != '' ])
+
+# page ranges selected for source pdfs, see find_pdfs()
+page_selections = {}
+# page counts and hashes of source pdfs indexed by (path, mtime, size)
+pdf_infos = {}
+# resized header and footer images and glyph atlases, see configure()
+resized_headers = {}
+glyph_atlases = {}
+
+def build(pdfs):
+    # determine the pages
+    nr_pages = [ None ] * len(pdfs)
+    page_sizes = [ None ] * len(pdfs)
+    pdf_hashes = [ None ] * len(pdfs)
+
+    def count_fn(i):
+        st = os.stat(pdfs[i])
+        key = (pdfs[i], st.st_mtime_ns, st.st_size)
+        if key not in pdf_infos:
+            pdf_hash = None
+            if prog_args.cache_dir is not None or remote is not None:
+                # also identifies the file uploaded to --workers
+                pdf_hash = file_hash(pdfs[i])
+            elif journal is not None:
+                # the journal only has to tell apart versions of the file
+                pdf_hash = repr(key)
+            # The page sizes are used to render the pages at their fitted
+            # size. If they can't be determined, render at the full size
+            # and resize afterwards.
+            sizes = None
+            if not prog_args.vector:
+                try:
+                    sizes = pdf_page_sizes(pdfs[i])
+                except CommandError as e:
+                    dbg(f'{e}, falling back to resizing after rendering')
+            nr = len(sizes) if sizes is not None else pdf_page_count(pdfs[i])
+            pdf_infos[key] = (nr, sizes, pdf_hash)
+        (nr_pages[i], page_sizes[i], pdf_hashes[i]) = pdf_infos[key]
+
+    for i in range(len(pdfs)):
+        pool.submit(f'counting pages of "{pdfs[i]}"', count_fn, i,
+                    cost=os.path.getsize(pdfs[i]))
+    check_failures(pool.wait())
+
+    setup_scratch_dir(sum(nr_pages))
+    if prog_args.max_scratch is None:
+        try:
+            pool.max_scratch = int((shutil.disk_usage(scratch_dir).free +
+                                    scratch_usage()) * 0.9)
+        except OSError:
+            pool.max_scratch = None
+    else:
+        pool.max_scratch = max_scratch or None
+
+    # Only the selected pages are rendered and processed. Numbering follows
+    # the selected pages.
+    docs = []
+    pages = []
+    for (pdf, nr, sizes) in zip(pdfs, nr_pages, page_sizes):
+        nrs = range(1, nr + 1)
+        if pdf in page_selections:
+            try:
+                nrs = selected_pages(page_selections[pdf], nr)
+            except Exception as e:
+                err(f'Invalid page selection for "{pdf}" ({e})')
+        doc_pages = [ Page(len(pages) + i, pdf, stem_name(pdf), page_nr)
+                      for (i, page_nr) in enumerate(nrs) ]
+        if sizes is not None:
+            for page in doc_pages:
+                page.fit = fit_size(sizes[page.nr - 1])
+        docs.append((pdf, doc_pages))
+        pages += doc_pages
+
+    if len(pages) < sum(nr_pages):
+        info(f'{len(pdfs)} pdfs with {len(pages)} selected out of {sum(nr_pages)} pages')
+    else:
+        info(f'{len(pdfs)} pdfs with {len(pages)} pages in total')
+
+    if prog_args.label_sep is not None:
+        for page in pages:
+            page.label = page.stem.split(prog_args.label_sep, 1)[0]
+
+    if number_start is not None:
+        for (i, page) in enumerate(pages):
+            page.number = number_start + i
+
+    if prog_args.proof:
+        write_promote_job(docs)
+
+    if prog_args.cache_dir is not None or journal is not None:
+        process_fingerprint = (
+            size, header_height, footer_height, body_height,
+            file_hash(prog_args.header) if prog_args.header is not None else None,
+            file_hash(prog_args.footer) if prog_args.footer is not None else None,
+            prog_args.fused, prog_args.backend,
+            prog_args.label_font, prog_args.label_color, prog_args.label_gravity,
+            label_height, label_margin,
+            prog_args.number_font, prog_args.number_color, prog_args.number_gravity,
+            number_height, number_margin)
+        for (pdf, pdf_hash, (_, doc_pages)) in zip(pdfs, pdf_hashes, docs):
+            for page in doc_pages:
+                page.src_key = cache_key('src', pdf_hash, page.nr, prog_args.dpi,
+                                         page.fit)
+                if layered:
+                    # labels and numbers are overlaid by the writer
+                    page.key = cache_key('page', page.src_key, process_fingerprint,
+                                         'bare')
+                    continue
+                page.key = cache_key('page', page.src_key, process_fingerprint,
+                                     page.label, page.number)
+                if not prog_args.fused and prog_args.backend == 'magick':
+                    page.body_key = cache_key('body', page.src_key,
+                                              process_fingerprint, page.label)
+
+    if prog_args.vector:
+        try:
+            write_vector_pdf(docs, output_path)
+            if prog_args.linearize:
+                linearize_pdf(output_path)
+        except CommandError as e:
+            err(e)
+        info('Done')
+        return
+
+    try:
+        if prog_args.label_sep is not None:
+            label_atlas.render(''.join(page.label for page in pages))
+        if number_start is not None:
+            number_atlas.render('0123456789-')
+    except CommandError as e:
+        err(e)
+
+    # With --encoding, pages are classified and their bodies re-encoded. The
+    # header and footer are drawn as separate images shared by all pages.
+    # They're flattened before the output pdf is created so that an error
+    # doesn't leave it behind.
+    header_layers = []
+    if prog_args.assemble == 'stream' and prog_args.encoding != 'rgb':
+        for (path, y) in [ (header_file, 0), (footer_file, size[1] - footer_height) ]:
+            if path is None:
+                continue
+            if not embeddable(path):
+                try:
+                    flatten_png(path, f'{path}.flat.png')
+                except CommandError as e:
+                    err(e)
+                path = f'{path}.flat.png'
+            header_layers.append((path, None, f'file:{path}', 0, y))
+
+    # With --assemble stream, pages are written into the output pdf as soon as
+    # they are processed.
+    output_pdf = None
+    # A split output is written into one pdf which is split into the parts
+    # once complete, so that the parts can be cut by their exact sizes.
+    if prog_args.assemble == 'stream':
+        path = output_path if not splitting else f'{output_path}.all'
+        info(f'Writing annotated pages into "{path}"...')
+        output_pdf = PdfWriter(path, prog_args.dpi)
+
+    # Render and process the pages in a pipeline. A page is queued for
+    # processing as soon as ghostscript finishes writing it out. At most
+    # render_slots render jobs run at a time and the other workers process
+    # the rendered pages while they are being rendered. Page jobs are
+    # prioritized over render jobs so that a new chunk isn't started while
+    # there are rendered pages waiting. The largest documents are rendered
+    # first so that they don't end up as the tail.
+    # With --dedupe, pages are identified by the hash of their rendered
+    # bitmap. Only the first page of each hash is processed and the rest
+    # share its image in the output pdf once all pages are processed.
+    dedupe_lock = threading.Lock()
+    dedupe_seen = set()
+    dedupe_dups = []
+
+    def is_dup(page):
+        if not prog_args.dedupe:
+            return False
+        page.image_key = 'src:' + file_hash(page.file)
+        with dedupe_lock:
+            dup = page.image_key in dedupe_seen
+            dedupe_seen.add(page.image_key)
+            if dup:
+                dedupe_dups.append(page)
+        if dup:
+            release_file(page.file)
+            page.file = None
+        return dup
+
+    def process_fn(pages):
+        pages = [ page for page in pages if not is_dup(page) ]
+        if len(pages) == 0:
+            return
+
+        process_pages(pages, lambda page: cache_put('body', page.body_key, page.file))
+        for page in pages:
+            cache_put('page', page.key, page.file)
+            journal_put('page', page.key, page.file)
+            output_fn(page)
+
+    def number_fn(page):
+        number_pages([ page ])
+        cache_put('page', page.key, page.file)
+        journal_put('page', page.key, page.file)
+        output_fn(page)
+
+    encoded_lock = threading.Lock()
+    encoded_classes = collections.Counter()
+    # layers of the written pages by image_key for the --dedupe duplicates
+    image_layers = {}
+
+    def output_fn(page):
+        if output_pdf is None:
+            return
+        if page.file is None:
+            # duplicate page whose image has already been written
+            output_pdf.add_layered_page(page.idx, size, image_layers[page.image_key] +
+                                        page_overlays(page))
+            return
+        if prog_args.dedupe and page.image_key is None:
+            page.image_key = 'page:' + file_hash(page.file)
+
+        cls = prog_args.encoding
+        if cls == 'auto':
+            with trace_span('classify', page.stem):
+                cls = classify_page(page.file)
+        if cls == 'jpeg':
+            cls = 'photo'
+        if cls != 'rgb':
+            info(f'Encoding "{page.stem}" as {cls}...')
+            with trace_span('encode', page.stem):
+                encode_body(page, cls)
+            layers = header_layers + [ (page.file, None, page.image_key, 0, header_height) ]
+        else:
+            if not embeddable(page.file):
+                dst = f'{scratch_dir}/FLAT_{page.stem}.png'
+                with trace_span('flatten', page.stem):
+                    flatten_png(page.file, dst)
+                release_file(page.file)
+                page.file = dst
+            layers = [ (page.file, None, page.image_key, 0, 0) ]
+        with encoded_lock:
+            encoded_classes[cls] += 1
+            if prog_args.dedupe:
+                image_layers[page.image_key] = layers
+
+        with trace_span('write', page.stem):
+            if layered:
+                output_pdf.add_layered_page(page.idx, size, layers + page_overlays(page))
+            else:
+                output_pdf.add_page(page.idx, page.file, size)
+        release_file(page.file)
+
+    # With --batch, rendered pages are processed in batches of batch_size
+    # by one ImageMagick process per stage. A batch is submitted once full or
+    # once all the pages to process have been rendered, whose number is
+    # known after the cache lookups below.
+    batch_size = 1
+    if prog_args.batch:
+        batch_size = prog_args.batch_size
+        if batch_size <= 0:
+            # enough batches for every worker to pipeline a few
+            batch_size = max(min(len(pages) // (prog_args.concurrency * 4),
+                                 BATCH_MAX_SIZE), 1)
+        dbg(f'batch_size={batch_size}')
+    batch_lock = threading.Lock()
+    batch_pages = []
+    nr_batched = 0
+    nr_to_process = None
+
+    def submit_batch(pages):
+        pool.submit(f'processing "{batch_desc(pages)}"', process_fn, pages,
+                    prio=PRIO_PAGE, mem=page_job_mem())
+
+    def page_done(page):
+        nonlocal nr_batched
+        with batch_lock:
+            batch_pages.append(page)
+            nr_batched += 1
+            if len(batch_pages) < batch_size and nr_batched != nr_to_process:
+                return
+            pages = batch_pages.copy()
+            batch_pages.clear()
+        submit_batch(pages)
+
+    def page_rendered(page):
+        cache_put('src', page.src_key, page.file)
+        journal_put('src', page.src_key, page.file)
+        page_done(page)
+
+    def render_fn(chunk):
+        (pdf, chunk_pages) = chunk
+        info(f'Rendering "{stem_name(pdf)}" pages '
+             f'{page_list([ page.nr for page in chunk_pages ])}...')
+        render_pages(pdf, chunk_pages, page_rendered)
+
+    # With --workers, the pages to render are sent to the workers in tasks
+    # of up to REMOTE_TASK_PAGES pages along with the options of the job.
+    # Files given to the options are uploaded and replaced by their copies on
+    # the workers. A task which fails is retried on the other workers and
+    # processed locally if none is left.
+    remote_argv = None
+    remote_files = {}
+    remote_uploads = {}
+    remote_lock = threading.Lock()
+    remote_done = collections.Counter()
+    if remote is not None:
+        remote_argv = job_options_argv(REMOTE_SKIP_ARGS)
+        for opt in REMOTE_FILE_OPTS:
+            if opt not in remote_argv:
+                continue
+            i = remote_argv.index(opt)
+            path = remote_argv[i + 1]
+            if os.path.isfile(path):
+                digest = file_hash(path)
+                remote_files[opt] = digest
+                remote_uploads[digest] = path
+                del remote_argv[i:i + 2]
+    pdf_digests = dict(zip(pdfs, pdf_hashes))
+
+    def local_rendered(page):
+        # pages of a failed task are processed right away instead of
+        # being counted into the batches
+        cache_put('src', page.src_key, page.file)
+        journal_put('src', page.src_key, page.file)
+        submit_batch([ page ])
+
+    def remote_fn(chunk):
+        (pdf, chunk_pages) = chunk
+        desc = f'"{stem_name(pdf)}" pages {page_list([ page.nr for page in chunk_pages ])}'
+        task = { 'argv': remote_argv, 'files': remote_files, 'pdf': pdf_digests[pdf],
+                 'pages': [ { 'stem': stem_name(pdf), 'nr': page.nr, 'fit': page.fit,
+                              'label': page.label, 'number': page.number }
+                            for page in chunk_pages ] }
+        files = dict(remote_uploads)
+        files[pdf_digests[pdf]] = pdf
+        tried = set()
+        while True:
+            addr = remote.acquire(tried)
+            if addr is None:
+                break
+            tried.add(addr)
+            info(f'Sending {desc} to {addr}...')
+            try:
+                remote.run(addr, task, chunk_pages, files)
+            except RemoteTaskError as e:
+                warn(f'Worker {addr} failed {desc} ({e})')
+                continue
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                remote.drop(addr, e)
+                continue
+            finally:
+                remote.release(addr)
+            with remote_lock:
+                remote_done[addr] += len(chunk_pages)
+            for page in chunk_pages:
+                cache_put('page', page.key, page.file)
+                journal_put('page', page.key, page.file)
+                output_fn(page)
+            return
+
+        warn(f'No worker left for {desc}, rendering locally')
+        with remote_lock:
+            remote_done['locally'] += len(chunk_pages)
+        info(f'Rendering {desc}...')
+        render_pages(pdf, chunk_pages, local_rendered)
+
+    # Pages found in the journal or cache skip rendering or the whole
+    # processing. Pages which only need to be renumbered, e.g. after a file
+    # is inserted before them, are numbered from the cached body. The rest
+    # are grouped into contiguous ranges of the same fitted size for
+    # rendering.
+    nr_cached = 0
+    nr_body_cached = 0
+    nr_src_cached = 0
+    nr_resumed = 0
+    nr_src_resumed = 0
+    nr_rendering = 0
+    for (pdf, doc_pages) in docs:
+        ranges = [ [] ]
+        for page in doc_pages:
+            cached_file = scratch_file('CACHED', page.stem)
+            resumed_file = journal_get('page', page.key)
+            resumed_src_file = journal_get('src', page.src_key)
+            if resumed_file is not None:
+                page.file = resumed_file
+                pool.submit(f'writing "{page.stem}"', output_fn, page, prio=PRIO_PAGE)
+                nr_resumed += 1
+            elif cache_get('page', page.key, cached_file):
+                page.file = cached_file
+                pool.submit(f'writing "{page.stem}"', output_fn, page, prio=PRIO_PAGE)
+                nr_cached += 1
+            elif cache_get('body', page.body_key, cached_file):
+                page.file = cached_file
+                pool.submit(f'numbering "{page.stem}"', number_fn, page, prio=PRIO_PAGE,
+                            mem=page_job_mem())
+                nr_body_cached += 1
+            elif resumed_src_file is not None:
+                page.file = resumed_src_file
+                page_done(page)
+                nr_src_resumed += 1
+            elif cache_get('src', page.src_key, page.file):
+                page_done(page)
+                nr_src_cached += 1
+            else:
+                # a render command renders all its pages at the same size
+                if len(ranges[-1]) > 0 and ranges[-1][-1].fit != page.fit:
+                    ranges.append([])
+                ranges[-1].append(page)
+                nr_rendering += 1
+                continue
+            if len(ranges[-1]) > 0:
+                ranges.append([])
+
+        if remote is not None:
+            for chunk_pages in [ r[i:i + REMOTE_TASK_PAGES] for r in ranges
+                                 for i in range(0, len(r), REMOTE_TASK_PAGES) ]:
+                pool.submit(f'sending "{pdf}" pages '
+                            f'{page_list([ page.nr for page in chunk_pages ])}',
+                            remote_fn, (pdf, chunk_pages),
+                            cost=len(chunk_pages), prio=PRIO_REMOTE,
+                            scratch=len(chunk_pages) * page_scratch_bytes())
             continue
-        labels.add(label)
 
-        args = [label]
-        args += generate_label_args(label, prog_args.label_font,
-                                    label_height, prog_args.label_color,
-                                    prog_args.label_gravity, label_file)
-        args_set.append(args)
+        for chunk_pages in [ chunk for r in ranges if len(r) > 0
+                             for chunk in split_render_chunks(r) ]:
+            pool.submit(f'rendering "{pdf}" pages '
+                        f'{page_list([ page.nr for page in chunk_pages ])}',
+                        render_fn, (pdf, chunk_pages),
+                        cost=len(chunk_pages), prio=PRIO_RENDER,
+                        mem=render_job_mem(),
+                        scratch=len(chunk_pages) * page_scratch_bytes())
 
-    def label_fn(args):
-        info(f'Generating label "{args[0]}"...')
-        run_convert(args[1:])
+    # flush the last batch if all the pages to process are already in
+    with batch_lock:
+        nr_to_process = nr_src_resumed + nr_src_cached
+        if remote is None:
+            nr_to_process += nr_rendering
+        pages_left = []
+        if nr_batched == nr_to_process and len(batch_pages) > 0:
+            pages_left = batch_pages.copy()
+            batch_pages.clear()
+    if len(pages_left) > 0:
+        submit_batch(pages_left)
 
-    run_parallel(args_set, label_fn, prog_args.concurrency)
+    if prog_args.resume:
+        info(f'{nr_resumed} processed and {nr_src_resumed} rendered pages '
+             f'resumed from the journal')
+    if prog_args.cache_dir is not None:
+        info(f'{nr_cached} processed, {nr_body_cached} unnumbered and '
+             f'{nr_src_cached} rendered pages found in cache')
 
-    dbg(f'label_files={label_files}')
+    failures = pool.wait()
+    if len(failures) == 0 and len(dedupe_dups) > 0:
+        for page in dedupe_dups:
+            pool.submit(f'writing "{page.stem}"', output_fn, page, prio=PRIO_PAGE)
+        failures = pool.wait()
+    if len(failures) > 0 and output_pdf is not None:
+        output_pdf.abort()
+    check_failures(failures)
+    if prog_args.dedupe:
+        info(f'{output_pdf.nr_shared} images shared, {len(dedupe_dups)} duplicate '
+             f'pages skipped processing')
+    if remote is not None and len(remote_done) > 0:
+        info('Pages processed by workers: ' +
+             ', '.join(f'{addr} {nr}' for (addr, nr) in sorted(remote_done.items())))
+    if prog_args.encoding != 'rgb':
+        info('Encoded pages: ' +
+             ', '.join(f'{nr} {cls}' for (cls, nr) in encoded_classes.most_common()))
 
-    # apply labels
-    srcs = apply_labels(srcs, label_files, 'LABELED', 'Labeling',
-                        label_height, prog_args.label_gravity, label_margin)
+    # collect the processed results into the output pdf or its parts
+    if output_pdf is not None:
+        with trace_span('close', output_path):
+            output_pdf.close()
+        if splitting:
+            try:
+                write_parts(split_parts(pages, output_pdf),
+                            lambda part, path: write_stream_part(output_pdf, part, path))
+            finally:
+                os.unlink(output_pdf.path)
+        elif prog_args.linearize:
+            try:
+                linearize_pdf(output_path)
+            except CommandError as e:
+                err(e)
+    elif splitting:
+        write_parts(split_parts(pages), collect_pages)
+    else:
+        try:
+            collect_pages(pages, output_path)
+        except CommandError as e:
+            err(e)
 
-# number
-if number_start is not None:
-    # generate numbers
-    number_height = int(size[1] * prog_args.number_height / 100)
-    number = number_start
-    number_files = {}
-    args_set = []
-    for src in srcs:
-        stem = os.path.splitext(src.split('_', 1)[1])[0]
-        number_file = f'{tempdir}/NUMBER_{number}.png'
-        number_files[src] = number_file
-
-        args = [number]
-        args += generate_label_args(f'{number}', prog_args.number_font,
-                                    number_height, prog_args.number_color,
-                                    prog_args.number_gravity, number_file)
-        args_set.append(args)
-        number += 1
-
-    def number_fn(args):
-        info(f'Generating page number "{args[0]}"...')
-        run_convert(args[1:])
-
-    run_parallel(args_set, number_fn, prog_args.concurrency)
-
-    dbg(f'number_files={number_files}')
-
-    # apply numbers
-    srcs = apply_labels(srcs, number_files, 'NUMBERED', 'Numbering',
-                        number_height, prog_args.number_gravity, number_margin)
-
-# collect the processed results into the output pdf
-output_path = prog_args.output
-if prog_args.numbered_output and os.path.exists(output_path):
-    (base, ext) = os.path.splitext(output_path)
-    nr = 1
-    while True:
-        output_path = f'{base}.{nr}{ext}'
-        if not os.path.exists(output_path):
-            break
-        nr += 1
+    if prog_args.cache_dir is not None:
+        evict_cache(cache_size)
+    if tracer is not None:
+        tracer.write(prog_args.trace)
+        tracer.print_summary()
+    info('Done')
+
+if prog_args.worker is not None:
+    run_worker(prog_args.worker)
+    sys.exit(0)
+if prog_args.serve is not None:
+    serve(prog_args.serve)
+    sys.exit(0)
+if prog_args.manifest is not None:
+    run_manifest(prog_args.manifest)
+    sys.exit(0)
+if prog_args.promote is not None:
+    run_promote(prog_args.promote)
+    sys.exit(0)
 
-args = [ '-format', 'pdf',
-         '-resize', f'{size[0]}x{size[1]}',
-         '-units', 'PixelsPerInch',
-         '-density', f'{prog_args.dpi}' ]
-args += [ f'{tempdir}/{src}' for src in srcs ]
-args.append(output_path)
+pdfs = find_pdfs()
+dbg(f'pdfs={pdfs}')
+configure()
+build(pdfs)
 
-info(f'Collecting annotated pages into "{output_path}"...')
-run_convert(args)
-info('Done')
+if prog_args.watch:
+    watch(pdfs)